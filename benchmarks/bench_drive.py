@@ -0,0 +1,144 @@
+"""
+Drive backup uploads: bot/gdrive.py against a local fake Drive API, with errors injected.
+
+Uploads --files random files in GDRIVE_CHUNK_MB chunks while the fake fails
+--burst chunk PUTs in a row after every --every chunks that went through,
+having kept only half of each failed chunk. The client has to back off,
+ask the fake where to resume and carry on from the last acknowledged byte.
+Checks that every file arrives byte for byte, is shared and shows up in the
+folder listing, and that every injected error was retried; fails (exit
+code 1) otherwise.
+
+The backoff is scaled down with --retry-delay (the bot waits RETRY_DELAY *
+2**n seconds, 1 * 2**n by default).
+
+Usage: python -m benchmarks.bench_drive [--files 4] [--size-mb 20] [--chunk-mb 2]
+                                        [--status 503] [--every 3] [--burst 2] [--verbose]
+"""
+import os
+import sys
+import json
+import re
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+import tempfile
+
+from benchmarks.fake_drive_api import FakeDriveAPI, service_account
+
+MB = 1024 * 1024
+FOLDER_ID = 'benchmark-folder'
+
+class RetryCounter(logging.Handler):
+    """Counts the retries bot.gdrive logs and how many followed each other"""
+    
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.retries = 0
+        self.max_attempt = 0
+    
+    def emit(self, record):
+        match = re.search(r'retry (\d+) in', record.getMessage())
+        if match:
+            self.retries += 1
+            self.max_attempt = max(self.max_attempt, int(match.group(1)))
+
+async def run(args):
+    api = FakeDriveAPI()
+    await api.start()
+    
+    os.environ.setdefault('BOT_TOKEN', 'benchmark')
+    os.environ.setdefault('OWNER_ID', '0')
+    os.environ.update(
+        GDRIVE_ENABLED='true',
+        GOOGLE_CREDENTIALS_JSON=json.dumps(service_account(f"{api.url}/token")),
+        GDRIVE_API_URL=f"{api.url}/",
+        GDRIVE_FOLDER_ID=FOLDER_ID,
+        GDRIVE_CHUNK_MB=str(args.chunk_mb),
+    )
+    # bot.config reads the environment on import, so only now that the fake has its port
+    from bot import gdrive
+    from bot.config import GDRIVE_MAX_RETRIES
+    if args.burst > GDRIVE_MAX_RETRIES:
+        sys.exit(f"--burst {args.burst} is more than GDRIVE_MAX_RETRIES={GDRIVE_MAX_RETRIES}, uploads would give up")
+    gdrive.RETRY_DELAY = args.retry_delay
+    counter = RetryCounter()
+    gdrive_logger = logging.getLogger('bot.gdrive')
+    gdrive_logger.setLevel(logging.WARNING)
+    gdrive_logger.propagate = args.verbose
+    gdrive_logger.addHandler(counter)
+    
+    api.inject_failures(args.status, args.every, args.burst)
+    client = gdrive.GDrive()
+    failed = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            checksums = {}
+            for index in range(args.files):
+                name = f"video{index}.mp4"
+                # not a multiple of the chunk size, the last chunk is a short one
+                data = os.urandom(args.size_mb * MB + 12345 * (index + 1))
+                with open(os.path.join(directory, name), 'wb') as f:
+                    f.write(data)
+                checksums[name] = hashlib.sha256(data).hexdigest()
+            
+            start = time.perf_counter()
+            links = await asyncio.gather(*(
+                client.upload_file(os.path.join(directory, name), name) for name in checksums
+            ))
+            elapsed = time.perf_counter() - start
+        listed = await asyncio.get_running_loop().run_in_executor(None, client.list_files, args.files)
+    finally:
+        await api.stop()
+    
+    uploaded = {entry['resource']['name']: entry for entry in api.files.values()}
+    for name, checksum in checksums.items():
+        entry = uploaded.get(name)
+        if entry is None:
+            failed.append(f"{name} was not uploaded")
+        elif hashlib.sha256(entry['data']).hexdigest() != checksum:
+            failed.append(f"{name} arrived corrupted ({len(entry['data'])} bytes)")
+        elif not any(permission.get('type') == 'anyone' for permission in entry['permissions']):
+            failed.append(f"{name} was not shared")
+    if not all(links):
+        failed.append("an upload returned no link")
+    if sorted(file['name'] for file in listed) != sorted(checksums):
+        failed.append(f"folder listing has {[file['name'] for file in listed]}")
+    if args.every and args.burst and not api.failures_injected:
+        failed.append("no error was injected, files are too small for --every")
+    if counter.retries != api.failures_injected:
+        failed.append(f"{api.failures_injected} errors injected but {counter.retries} retries logged")
+    if api.failures_injected and counter.max_attempt != args.burst:
+        failed.append(f"expected up to {args.burst} retries in a row, saw {counter.max_attempt}")
+    
+    total = sum(len(entry['data']) for entry in api.files.values())
+    print(f"{len(api.files)} files, {total / MB:.1f} MB in {elapsed:.2f}s: {total / MB / elapsed:.1f} MB/s")
+    print(f"chunk PUTs: {api.chunk_puts}, {args.status} errors injected: {api.failures_injected}, "
+          f"retries: {counter.retries} (up to {counter.max_attempt} in a row), resume queries: {api.status_queries}")
+    print(f"bytes sent: {api.bytes_received / MB:.1f} MB ({api.bytes_received / total - 1:.1%} resent), "
+          f"token requests: {api.token_requests}")
+    for problem in failed:
+        print(f"❌ {problem}")
+    if not failed:
+        print("✅ all uploads complete and intact")
+    return not failed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--size-mb', type=int, default=20)
+    parser.add_argument('--chunk-mb', type=int, default=2)
+    parser.add_argument('--status', type=int, default=503, help="error status of the injected failures")
+    parser.add_argument('--every', type=int, default=3, help="chunks that go through between failures")
+    parser.add_argument('--burst', type=int, default=2, help="failures in a row")
+    parser.add_argument('--retry-delay', type=float, default=0.05, help="backoff base in seconds")
+    parser.add_argument('--verbose', action='store_true', help="show the retries bot.gdrive logs")
+    args = parser.parse_args()
+    
+    logging.basicConfig(format='%(levelname)s %(name)s: %(message)s', level=logging.ERROR)
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+if __name__ == '__main__':
+    main()
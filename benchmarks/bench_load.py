@@ -0,0 +1,344 @@
+"""
+End-to-end load test: the real bot (run.py) against a local fake Bot API server.
+
+Every simulated user redeems an auth key, sends a thumbnail and then a batch
+of videos, the way people use the bot. Latencies are measured from handing
+the update to the bot until its answer arrives at the fake server:
+  auth       key message -> "Subscription Activated"
+  thumbnail  photo -> "Thumbnail saved"
+  video_ack  video -> "Added to queue"
+  video      video -> processed video sent back (its status message deleted)
+With --album each user's videos are sent as one album and come back as one.
+
+The bot runs as a separate process with its normal config, so settings under
+test can be passed with --bot-env (e.g. MAX_CONCURRENT_JOBS=4).
+
+Usage: python -m benchmarks.bench_load [--users 100] [--videos 2] [--mode polling|webhook]
+                                       [--bot-env MAX_CONCURRENT_UPDATES=32] [--output load.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import socket
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+os.environ.setdefault('BOT_TOKEN', 'benchmark')
+os.environ.setdefault('OWNER_ID', '0')
+os.environ['GDRIVE_ENABLED'] = 'false'
+
+from aiohttp import ClientSession, ClientError
+from bot.database import Database
+from bot.handlers import generate_auth_key
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.bench_processing import SIZES, PROFILES, MB, generate_video, generate_image, percentile, metadata
+
+TOKEN = '123456789:LOADTEST'
+OWNER_ID = 1
+FIRST_USER_ID = 100000
+
+class SessionFailed(Exception):
+    pass
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def latency_stats(timings):
+    if not timings:
+        return {'count': 0}
+    return {
+        'count': len(timings),
+        'p50_ms': round(statistics.median(timings) * 1000, 1),
+        'p95_ms': round(percentile(timings, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 1),
+        'max_ms': round(max(timings) * 1000, 1),
+    }
+
+class LoadTest:
+    def __init__(self, api, args, video, thumbnail):
+        self.api = api
+        self.args = args
+        self.video = video
+        self.thumbnail = thumbnail
+        self.timings = {'auth': [], 'thumbnail': [], 'video_ack': [], 'video': []}
+        self.videos_done = 0
+        self.videos_failed = 0
+        self.sessions_failed = 0
+    
+    async def reply(self, user_id, deadline, accept):
+        """Wait for the bot's call in this chat that accept() returns a value for"""
+        while True:
+            call = await self.api.next_call(user_id, max(deadline - time.monotonic(), 0.001))
+            value = accept(call)
+            if value is not None:
+                return call, value
+    
+    async def ask(self, name, user_id, deadline, expected, **message):
+        """Send a message and time the text answer that starts with expected"""
+        started = time.monotonic()
+        await self.api.send_update(user_id, **message)
+        
+        def accept(call):
+            text = call.params.get('text', '')
+            if call.method == 'sendMessage':
+                if text.startswith(expected):
+                    return True
+                raise SessionFailed(f"{name}: {text[:80]!r}")
+        call, _ = await self.reply(user_id, deadline, accept)
+        self.timings[name].append(call.at - started)
+    
+    async def session(self, user_id, key):
+        deadline = time.monotonic() + self.args.timeout
+        await self.ask('auth', user_id, deadline, '✅ **Subscription Activated', text=key)
+        
+        width, height, photo_id = self.thumbnail
+        photo = [{**self.api.file_object(photo_id), 'width': width, 'height': height}]
+        await self.ask('thumbnail', user_id, deadline, '✅ Thumbnail saved', photo=photo)
+        
+        if self.args.album:
+            await self.album(user_id, deadline)
+            return
+        
+        sent = []
+        for index in range(self.args.videos):
+            if index and self.args.think_time:
+                await asyncio.sleep(random.uniform(0, 2 * self.args.think_time))
+            sent.append(time.monotonic())
+            await self.api.send_update(user_id, video=self.video_object(user_id, index))
+        
+        # each video gets its own status message, deleted once the result is sent
+        statuses = {}
+        pending = len(sent)
+        
+        def accept(call):
+            if call.method == 'sendMessage' and call.params.get('text', '').startswith('🕒'):
+                return ('ack', call.result['message_id'])
+            if call.method == 'deleteMessage':
+                return ('done', int(call.params['message_id']))
+            if call.method == 'editMessageText' and call.params['text'].startswith('❌'):
+                print(f"❌ User {user_id}: {call.params['text'][:200]}")
+                return ('failed', int(call.params['message_id']))
+        while pending:
+            call, (event, message_id) = await self.reply(user_id, deadline, accept)
+            if event == 'ack':
+                # the user's updates are handled in order, so acks arrive in send order
+                started = sent[len(statuses)]
+                statuses[message_id] = started
+                self.timings['video_ack'].append(call.at - started)
+            elif message_id in statuses:
+                pending -= 1
+                if event == 'done':
+                    self.videos_done += 1
+                    self.timings['video'].append(call.at - statuses[message_id])
+                else:
+                    self.videos_failed += 1
+    
+    async def album(self, user_id, deadline):
+        """All videos as one media group, answered by one status message and one album"""
+        started = time.monotonic()
+        for index in range(self.args.videos):
+            await self.api.send_update(
+                user_id, video=self.video_object(user_id, index), media_group_id=f"album{user_id}"
+            )
+        
+        def accept(call):
+            if call.method == 'sendMessage' and call.params.get('text', '').startswith('🎞️'):
+                return 'ack'
+            if call.method in ('sendMediaGroup', 'sendVideo'):
+                return 'done'
+            if call.method == 'editMessageText' and call.params['text'].startswith('❌'):
+                print(f"❌ User {user_id}: {call.params['text'][:200]}")
+                return 'failed'
+        done = 0
+        while True:
+            call, event = await self.reply(user_id, deadline, accept)
+            if event == 'ack':
+                self.timings['video_ack'].append(call.at - started)
+            elif event == 'done':
+                done = len(call.result) if isinstance(call.result, list) else 1
+                self.videos_done += done
+                self.timings['video'].extend([call.at - started] * done)
+                # a partly failed album is reported right after it is sent
+                if done == self.args.videos:
+                    return
+            else:
+                self.videos_failed += self.args.videos - done
+                return
+    
+    def video_object(self, user_id, index):
+        path, file_path, size, width, height, seconds = self.video
+        # a unique file per message, or the bot would answer from its result cache
+        file_id = self.api.add_file(path, file_path, size, file_unique_id=f"v{user_id}_{index}")
+        extension = os.path.splitext(path)[1]
+        return {
+            **self.api.file_object(file_id),
+            'width': width,
+            'height': height,
+            'duration': seconds,
+            'mime_type': 'video/x-matroska' if extension == '.mkv' else f"video/{extension[1:]}",
+            'file_name': f"video_{index}{extension}",
+        }
+    
+    async def run_session(self, user_id, key, delay):
+        await asyncio.sleep(delay)
+        try:
+            await self.session(user_id, key)
+        except (SessionFailed, asyncio.TimeoutError) as e:
+            self.sessions_failed += 1
+            print(f"❌ User {user_id}: {e or 'timed out'}")
+
+def seed_keys(db_file, count):
+    db = Database(db_file, db_file + '.json')
+    keys = [generate_auth_key() for _ in range(count)]
+    for key in keys:
+        db.create_auth_key(key, 86400)
+    db.close()
+    return keys
+
+def start_bot(args, workdir, api, bot_port):
+    env = dict(os.environ)
+    env.update({
+        'BOT_TOKEN': TOKEN,
+        'OWNER_ID': str(OWNER_ID),
+        'BOT_API_URL': api.url,
+        'PORT': str(bot_port),
+        'DATABASE_FILE': os.path.join(workdir, 'load.db'),
+        'GDRIVE_ENABLED': 'false',
+        'WEBHOOK_URL': f"http://127.0.0.1:{bot_port}" if args.mode == 'webhook' else '',
+    })
+    for setting in args.bot_env:
+        name, _, value = setting.partition('=')
+        env[name] = value
+    log = open(os.path.join(workdir, 'bot.log'), 'w')
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(repo_dir, 'run.py')],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    return process, log
+
+async def scrape_metrics(bot_port):
+    """The bot's own counters at the end of the run (sums and counts, no buckets)"""
+    try:
+        async with ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{bot_port}/metrics") as response:
+                text = await response.text()
+    except ClientError:
+        return {}
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith('#') or '_bucket' in line or not line.strip():
+            continue
+        name, _, value = line.rpartition(' ')
+        samples[name] = float(value)
+    return samples
+
+async def run(args, workdir):
+    media_dir = os.path.join(workdir, 'media')
+    os.makedirs(media_dir, exist_ok=True)
+    video_path = generate_video(media_dir, args.profile, args.size)
+    thumb_path = generate_image(media_dir, 1280, 720)
+    keys = seed_keys(os.path.join(workdir, 'load.db'), args.users)
+    
+    api = FakeBotAPI(TOKEN)
+    await api.start()
+    width, height, seconds, _ = SIZES[args.size]
+    video_size = os.path.getsize(video_path)
+    video = (video_path, f"videos/{os.path.basename(video_path)}", video_size, width, height, seconds)
+    photo_id = api.add_file(thumb_path, 'photos/thumb.png', os.path.getsize(thumb_path))
+    
+    bot_port = free_port()
+    process, log = start_bot(args, workdir, api, bot_port)
+    load = LoadTest(api, args, video, (1280, 720, photo_id))
+    try:
+        ready = asyncio.create_task(api.ready.wait())
+        while not ready.done():
+            if process.poll() is not None:
+                raise SystemExit(f"❌ The bot exited during startup, see {log.name}")
+            await asyncio.sleep(0.1)
+        print(f"🤖 Bot ready ({args.mode}), {args.users} users x {args.videos} videos of {args.profile} {args.size}")
+        
+        started = time.monotonic()
+        await asyncio.gather(*(
+            load.run_session(FIRST_USER_ID + index, key, args.ramp_up * index / args.users)
+            for index, key in enumerate(keys)
+        ))
+        wall = time.monotonic() - started
+        bot_metrics = await scrape_metrics(bot_port)
+    finally:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+            try:
+                # the fake server has to keep answering while the bot shuts down
+                await asyncio.get_running_loop().run_in_executor(None, process.wait, 30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        log.close()
+        await api.stop()
+    
+    return {
+        'meta': metadata(args),
+        'wall_s': round(wall, 2),
+        'videos_done': load.videos_done,
+        'videos_failed': load.videos_failed,
+        'sessions_failed': load.sessions_failed,
+        'videos_per_s': round(load.videos_done / wall, 3),
+        'mb_per_s': round(load.videos_done * video_size / MB / wall, 3),
+        'updates_per_s': round(args.users * (2 + args.videos) / wall, 3),
+        'latency': {name: latency_stats(timings) for name, timings in load.timings.items()},
+        'uploaded_mb': round(api.bytes_uploaded / MB, 2),
+        'bot_api_calls': dict(api.method_counts),
+        'bot_metrics': bot_metrics,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--videos', type=int, default=2, help="videos each user sends")
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling')
+    parser.add_argument('--size', choices=list(SIZES), default='360p')
+    parser.add_argument('--profile', choices=list(PROFILES), default='mp4_h264_aac')
+    parser.add_argument('--ramp-up', type=float, default=5, help="seconds over which the users start")
+    parser.add_argument('--album', action='store_true', help="send each user's videos as one album")
+    parser.add_argument('--think-time', type=float, default=0.5, help="average pause between a user's videos")
+    parser.add_argument('--timeout', type=float, default=600, help="seconds a user session may take")
+    parser.add_argument('--bot-env', nargs='*', default=[], metavar='NAME=VALUE',
+                        help="extra environment for the bot process")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--keep', help="work in this directory and keep it (media, bot.log, database)")
+    args = parser.parse_args()
+    
+    workdir = os.path.abspath(args.keep) if args.keep else tempfile.mkdtemp(prefix='bench_load_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        results = asyncio.run(run(args, workdir))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    
+    print(f"\n{results['videos_done']} videos in {results['wall_s']}s: {results['videos_per_s']} videos/s, "
+          f"{results['mb_per_s']} MB/s, {results['videos_failed']} failed, "
+          f"{results['sessions_failed']} sessions failed")
+    print(f"{'':<10} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, stats in results['latency'].items():
+        if stats['count']:
+            print(f"{name:<10} {stats['count']:>6} {stats['p50_ms']:>9} {stats['p95_ms']:>9} "
+                  f"{stats['p99_ms']:>9} {stats['max_ms']:>9}")
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+"""
+Processing path benchmark on synthetic videos generated with ffmpeg's lavfi sources.
+
+Sections (all run by default, pick some with --only):
+  process    process_video_with_thumbnail per container/codec/size and concurrency
+  pipeline   download -> process -> upload through VideoJobQueue against a stubbed Bot API
+  thumbnail  thumbnail resize (cache miss) and cache hit latency per image size
+  database   Database operation cost vs. table size
+
+Usage: python -m benchmarks.bench_processing [--sizes 360p 720p] [--concurrency 1 2 4]
+                                             [--only process database] [--output results.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+os.environ.setdefault('BOT_TOKEN', 'benchmark')
+os.environ.setdefault('OWNER_ID', '0')
+os.environ['GDRIVE_ENABLED'] = 'false'
+
+from bot import handlers
+from bot import video_processor
+from bot.database import Database
+from bot.job_queue import VideoJob, VideoJobQueue, Stage
+from bot.thumb_cache import ThumbnailCache, prepare_thumbnail
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MB = 1024 * 1024
+
+# name: (width, height, seconds, video bitrate)
+SIZES = {
+    '360p': (640, 360, 5, '1M'),
+    '720p': (1280, 720, 10, '3M'),
+    '1080p': (1920, 1080, 10, '6M'),
+}
+# name: (extension, codec arguments); each one lands on a different thumbnail strategy
+PROFILES = {
+    'mp4_h264_aac': ('.mp4', ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-c:a', 'aac']),
+    'mkv_h264_aac': ('.mkv', ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-c:a', 'aac']),
+    'mkv_vp9_vorbis': ('.mkv', ['-c:v', 'libvpx-vp9', '-deadline', 'realtime', '-cpu-used', '8', '-c:a', 'libvorbis']),
+    'avi_mpeg4_pcm': ('.avi', ['-c:v', 'mpeg4', '-c:a', 'pcm_s16le']),
+}
+IMAGE_SIZES = [(640, 360), (1920, 1080), (4000, 3000)]
+DB_SIZES = [1000, 10000, 100000]
+
+def ffmpeg(*args):
+    subprocess.run(['ffmpeg', '-v', 'error', '-y', *args], check=True)
+
+def generate_video(directory, profile, size):
+    extension, codec_args = PROFILES[profile]
+    width, height, seconds, bitrate = SIZES[size]
+    path = os.path.join(directory, f"{profile}_{size}{extension}")
+    if not os.path.exists(path):
+        ffmpeg(
+            '-f', 'lavfi', '-i', f"testsrc2=size={width}x{height}:rate=30:duration={seconds}",
+            '-f', 'lavfi', '-i', f"sine=frequency=440:duration={seconds}",
+            *codec_args, '-b:v', bitrate, '-shortest', path
+        )
+    return path
+
+def generate_image(directory, width, height):
+    path = os.path.join(directory, f"thumb_{width}x{height}.png")
+    if not os.path.exists(path):
+        ffmpeg('-f', 'lavfi', '-i', f"testsrc2=size={width}x{height}", '-frames:v', '1', path)
+    return path
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def latency_stats(timings):
+    return {
+        'p50_ms': round(statistics.median(timings) * 1000, 3),
+        'p95_ms': round(percentile(timings, 0.95) * 1000, 3),
+        'max_ms': round(max(timings) * 1000, 3),
+    }
+
+async def bench_process(video_path, thumb_path, concurrency, jobs):
+    video_processor._job_semaphore = asyncio.Semaphore(concurrency)
+    # warm-up: the first job also fills the thumbnail cache
+    os.remove(await video_processor.process_video_with_thumbnail(video_path, thumb_path))
+    timings = []
+    
+    async def one():
+        started = time.perf_counter()
+        output = await video_processor.process_video_with_thumbnail(video_path, thumb_path)
+        timings.append(time.perf_counter() - started)
+        os.remove(output)
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(jobs)))
+    wall = time.perf_counter() - started
+    size = os.path.getsize(video_path)
+    return {
+        'concurrency': concurrency,
+        'jobs': jobs,
+        'jobs_per_s': round(jobs / wall, 3),
+        'mb_per_s': round(jobs * size / MB / wall, 3),
+        **latency_stats(timings),
+    }
+
+class StubFile:
+    def __init__(self, source, network_mbps):
+        self.file_path = source
+        self.network_mbps = network_mbps
+    
+    async def download_to_drive(self, path):
+        await simulate_transfer(os.path.getsize(self.file_path), self.network_mbps)
+        await asyncio.get_running_loop().run_in_executor(None, shutil.copyfile, self.file_path, path)
+
+class StubBot:
+    """The Bot API calls the pipeline makes, answered locally"""
+    
+    def __init__(self, sources, network_mbps):
+        self.sources = sources
+        self.network_mbps = network_mbps
+    
+    async def get_file(self, file_id):
+        return StubFile(self.sources[file_id], self.network_mbps)
+
+class StubMessage:
+    def __init__(self, bot, network_mbps=0):
+        self.bot = bot
+        self.network_mbps = network_mbps
+        self.message_id = 1
+        self.chat_id = 1
+        self.video = None
+    
+    async def edit_text(self, text, **kwargs):
+        return self
+    
+    async def delete(self):
+        return True
+    
+    async def reply_video(self, video, **kwargs):
+        size = os.fstat(video.fileno()).st_size
+        await simulate_transfer(size, self.network_mbps)
+        sent = StubMessage(self.bot)
+        sent.video = StubVideo('sent', 'sent', size)
+        return sent
+
+class StubVideo:
+    def __init__(self, file_id, file_name, file_size, mime_type='video/mp4'):
+        self.file_id = file_id
+        self.file_unique_id = file_id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.mime_type = mime_type
+
+class StubUpdate:
+    def __init__(self, message):
+        self.message = message
+
+class StubContext:
+    def __init__(self, bot):
+        self.bot = bot
+
+async def simulate_transfer(size, network_mbps):
+    if network_mbps:
+        await asyncio.sleep(size * 8 / (network_mbps * 1000 * 1000))
+
+async def bench_pipeline(videos, thumb_path, concurrency, jobs, network_mbps):
+    video_processor._job_semaphore = asyncio.Semaphore(concurrency)
+    sources = {f"video{index}": path for index, path in enumerate(videos)}
+    bot = StubBot(sources, network_mbps)
+    context = StubContext(bot)
+    done = asyncio.Event()
+    timings = []
+    failures = []
+    
+    async def upload(job):
+        await handlers.upload_video(job)
+        timings.append(time.monotonic() - job.enqueued_at)
+        if len(timings) + len(failures) == jobs:
+            done.set()
+    
+    async def failed(job, error):
+        failures.append(repr(error))
+        await handlers.video_job_failed(job, error)
+        if len(timings) + len(failures) == jobs:
+            done.set()
+    
+    queue = VideoJobQueue(
+        [
+            Stage('download', handlers.download_video, concurrency),
+            Stage('process', handlers.change_thumbnail, concurrency),
+            Stage('upload', upload, concurrency),
+        ],
+        on_error=failed
+    )
+    await queue.start()
+    total_bytes = 0
+    started = time.monotonic()
+    for index in range(jobs):
+        file_id = f"video{index % len(videos)}"
+        source = sources[file_id]
+        total_bytes += os.path.getsize(source)
+        video = StubVideo(file_id, os.path.basename(source), os.path.getsize(source), mime_type=None)
+        message = StubMessage(bot, network_mbps)
+        job = VideoJob(index % 4, StubUpdate(message), context, StubMessage(bot), video, thumb_path)
+        queue.put(job)
+    await done.wait()
+    wall = time.monotonic() - started
+    await queue.stop()
+    result = {
+        'concurrency': concurrency,
+        'jobs': jobs,
+        'network_mbps': network_mbps,
+        'failed': len(failures),
+        'jobs_per_s': round(jobs / wall, 3),
+        'mb_per_s': round(total_bytes / MB / wall, 3),
+    }
+    if timings:
+        result.update(latency_stats(timings))
+    return result
+
+def bench_thumbnails(image_dir, repeats):
+    os.makedirs(image_dir, exist_ok=True)
+    results = []
+    cache = ThumbnailCache(os.path.join(image_dir, 'cache'))
+    for width, height in IMAGE_SIZES:
+        source = generate_image(image_dir, width, height)
+        resize = []
+        for index in range(repeats):
+            started = time.perf_counter()
+            prepare_thumbnail(source, os.path.join(image_dir, f"out_{index}.jpg"))
+            resize.append(time.perf_counter() - started)
+        
+        cache.release(cache.acquire(source))
+        hits = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            path = cache.acquire(source)
+            hits.append(time.perf_counter() - started)
+            cache.release(path)
+        results.append({
+            'image': f"{width}x{height}",
+            'resize_p50_ms': round(statistics.median(resize) * 1000, 3),
+            'cache_hit_p50_ms': round(statistics.median(hits) * 1000, 3),
+        })
+    return results
+
+def timed_ops(operation, count):
+    timings = []
+    for index in range(count):
+        started = time.perf_counter()
+        operation(index)
+        timings.append(time.perf_counter() - started)
+    return latency_stats(timings)
+
+def bench_database(directory, size, count):
+    path = os.path.join(directory, f"bench_{size}.db")
+    db = Database(path, os.path.join(directory, 'none.json'))
+    now = datetime.now().isoformat()
+    expires = datetime(2100, 1, 1).isoformat()
+    with db.transaction() as cur:
+        cur.executemany(
+            "INSERT INTO subscriptions (user_id, expires_at, activated_at) VALUES (?, ?, ?)",
+            ((user_id, expires, now) for user_id in range(size))
+        )
+        cur.executemany(
+            "INSERT INTO auth_keys (key, duration_seconds, created_at, used) VALUES (?, ?, ?, 1)",
+            ((f"K{index:011d}", 86400, now) for index in range(size))
+        )
+    for index in range(count):
+        db.create_auth_key(f"N{index:011d}", 86400)
+    
+    def uncached_lookup(index):
+        db._subscriptions.clear()
+        db.get_subscription((index * 7919) % size)
+    
+    def increment_and_flush(index):
+        for user_id in range(50):
+            db.increment_videos_processed((index * 50 + user_id) % size)
+        db.flush()
+    
+    def backup_roundtrip(index):
+        db.remove_backup(db.add_backup('backups/x.mp4', 'x.mp4', 1, index, 'caption'))
+    
+    result = {
+        'rows': size,
+        'get_subscription_uncached': timed_ops(uncached_lookup, count),
+        'redeem_auth_key': timed_ops(lambda index: db.redeem_auth_key(f"N{index:011d}", size + index), count),
+        'increment_50_and_flush': timed_ops(increment_and_flush, count),
+        'backup_add_remove': timed_ops(backup_roundtrip, count),
+    }
+    db.close()
+    return result
+
+def metadata(args):
+    def output(cmd):
+        try:
+            return subprocess.run(cmd, capture_output=True, text=True, cwd=REPO_DIR).stdout.strip()
+        except OSError:
+            return None
+    ffmpeg_version = output(['ffmpeg', '-version'])
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': output(['git', 'rev-parse', '--short', 'HEAD']),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'ffmpeg': ffmpeg_version.splitlines()[0] if ffmpeg_version else None,
+        'args': vars(args),
+    }
+
+async def run(args, workdir):
+    results = {'meta': metadata(args)}
+    media_dir = os.path.join(workdir, 'media')
+    os.makedirs(media_dir, exist_ok=True)
+    thumb_path = generate_image(media_dir, 1280, 720)
+    
+    if 'process' in args.only:
+        results['process'] = []
+        for size in args.sizes:
+            for profile in args.profiles:
+                video_path = generate_video(media_dir, profile, size)
+                strategy = video_processor.choose_strategy(await video_processor.probe_video(video_path))
+                for concurrency in args.concurrency:
+                    result = await bench_process(video_path, thumb_path, concurrency, args.jobs)
+                    result.update({'profile': profile, 'size': size, 'strategy': strategy,
+                                   'file_mb': round(os.path.getsize(video_path) / MB, 2)})
+                    results['process'].append(result)
+                    print(f"process   {profile:<16} {size:<6} c={concurrency:<3} {strategy:<15} "
+                          f"{result['jobs_per_s']:>8.2f} jobs/s {result['p50_ms']:>10.1f} ms p50")
+    
+    if 'pipeline' in args.only:
+        results['pipeline'] = []
+        db = Database(os.path.join(workdir, 'pipeline.db'), os.path.join(workdir, 'none.json'))
+        handlers.setup(db)
+        videos = [generate_video(media_dir, profile, args.sizes[0]) for profile in args.profiles]
+        for concurrency in args.concurrency:
+            result = await bench_pipeline(videos, thumb_path, concurrency, args.jobs * len(videos), args.network_mbps)
+            results['pipeline'].append(result)
+            print(f"pipeline  c={concurrency:<3} {result['jobs_per_s']:>8.2f} jobs/s "
+                  f"{result.get('p50_ms', 0):>10.1f} ms p50 {result['failed']} failed")
+        db.close()
+    
+    if 'thumbnail' in args.only:
+        results['thumbnail'] = bench_thumbnails(os.path.join(workdir, 'images'), args.repeats)
+        for result in results['thumbnail']:
+            print(f"thumbnail {result['image']:<10} resize {result['resize_p50_ms']:>8.2f} ms "
+                  f"cache hit {result['cache_hit_p50_ms']:>6.3f} ms")
+    
+    if 'database' in args.only:
+        results['database'] = []
+        for size in args.db_sizes:
+            result = bench_database(workdir, size, args.repeats * 20)
+            results['database'].append(result)
+            print(f"database  {size:>8} rows  lookup {result['get_subscription_uncached']['p50_ms']:.3f} ms  "
+                  f"redeem {result['redeem_auth_key']['p50_ms']:.3f} ms  "
+                  f"flush {result['increment_50_and_flush']['p50_ms']:.3f} ms")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--only', nargs='+', default=['process', 'pipeline', 'thumbnail', 'database'],
+                        choices=['process', 'pipeline', 'thumbnail', 'database'])
+    parser.add_argument('--sizes', nargs='+', default=['360p', '720p'], choices=list(SIZES))
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES), choices=list(PROFILES))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--jobs', type=int, default=4, help="jobs per measurement (per video in the pipeline)")
+    parser.add_argument('--network-mbps', type=float, default=0,
+                        help="simulated Bot API bandwidth for the pipeline, 0 = local copy speed")
+    parser.add_argument('--db-sizes', type=int, nargs='+', default=DB_SIZES)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--keep', help="generate media into this directory and keep it between runs")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    
+    workdir = os.path.abspath(args.keep) if args.keep else tempfile.mkdtemp(prefix='bench_processing_')
+    os.makedirs(workdir, exist_ok=True)
+    # the processor writes to downloads/, outputs/ and the thumbnail cache relative to the cwd
+    os.chdir(workdir)
+    for directory in ('downloads', 'outputs'):
+        os.makedirs(directory, exist_ok=True)
+    try:
+        results = asyncio.run(run(args, workdir))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {output}")
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
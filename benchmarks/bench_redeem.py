@@ -0,0 +1,69 @@
+"""
+Auth key redeem latency vs. number of generated keys.
+
+Usage: python -m benchmarks.bench_redeem [--sizes 1000 10000 100000 1000000]
+"""
+import os
+import sys
+import time
+import string
+import secrets
+import argparse
+import tempfile
+import statistics
+
+os.environ.setdefault('BOT_TOKEN', 'benchmark')
+os.environ.setdefault('OWNER_ID', '0')
+
+from bot.database import Database
+
+KEY_CHARS = string.ascii_uppercase + string.digits
+
+def random_key():
+    return ''.join(secrets.choice(KEY_CHARS) for _ in range(12))
+
+def fill_keys(db, count):
+    created_at = '2024-01-01T00:00:00'
+    with db.transaction() as cur:
+        cur.executemany(
+            "INSERT INTO auth_keys (key, duration_seconds, created_at, used) VALUES (?, ?, ?, ?)",
+            ((f"K{i:011d}", 86400, created_at, i % 2) for i in range(count))
+        )
+
+def bench_size(size, redeems):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'), os.path.join(tmp, 'none.json'))
+        fill_keys(db, size)
+        
+        keys = [random_key() for _ in range(redeems)]
+        for key in keys:
+            db.create_auth_key(key, 86400)
+        
+        timings = []
+        for user_id, key in enumerate(keys, start=1):
+            started = time.perf_counter()
+            assert db.redeem_auth_key(key, user_id)
+            timings.append((time.perf_counter() - started) * 1000)
+        db.close()
+    
+    timings.sort()
+    return {
+        'keys': size,
+        'p50_ms': statistics.median(timings),
+        'p99_ms': timings[int(len(timings) * 0.99) - 1],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--redeems', type=int, default=500)
+    args = parser.parse_args()
+    
+    print(f"{'keys':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for size in args.sizes:
+        result = bench_size(size, args.redeems)
+        print(f"{result['keys']:>10} {result['p50_ms']:>10.3f} {result['p99_ms']:>10.3f}")
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
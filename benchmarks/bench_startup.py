@@ -0,0 +1,75 @@
+"""
+Cold start budget: import time of bot.main measured with python -X importtime.
+
+Both with Drive backups off and on (the queue main() builds is created too,
+as render.yaml enables them). Fails (exit code 1) when the median import
+time exceeds the budget or when a module that should only load on first
+use is imported at startup.
+
+Usage: python -m benchmarks.bench_startup [--runs 5] [--budget-ms 300]
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+# Only needed once a thumbnail or Drive backup is actually processed
+LAZY_MODULES = ('PIL', 'googleapiclient', 'google.oauth2')
+
+# startup up to the point main() has its services, short of connecting to Telegram
+STARTUP_CODE = 'import bot.main; bot.main.create_drive_backup(None)'
+
+def measure(gdrive_enabled):
+    """Start the bot in a fresh interpreter, returns {module: (self_us, cumulative_us)}"""
+    env = dict(os.environ)
+    env.setdefault('BOT_TOKEN', 'benchmark')
+    env.setdefault('OWNER_ID', '0')
+    env['GDRIVE_ENABLED'] = 'true' if gdrive_enabled else 'false'
+    env['GOOGLE_CREDENTIALS_JSON'] = '{"type": "service_account"}'
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', STARTUP_CODE],
+        env=env, capture_output=True, text=True, check=True
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=300)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+    
+    failed = False
+    for gdrive_enabled in (False, True):
+        runs = [measure(gdrive_enabled) for _ in range(args.runs)]
+        totals = [run['bot.main'][1] / 1000 for run in runs]
+        median = statistics.median(totals)
+        
+        last = runs[-1]
+        print(f"\nGDRIVE_ENABLED={str(gdrive_enabled).lower()}")
+        print(f"{'module':<40} {'cumulative ms':>14}")
+        top_level = [(name, times) for name, times in last.items() if name.startswith('bot.') or '.' not in name]
+        for name, (_, cumulative) in sorted(top_level, key=lambda item: -item[1][1])[:args.top]:
+            print(f"{name:<40} {cumulative / 1000:>14.1f}")
+        print(f"bot.main import: median {median:.1f} ms over {args.runs} runs (budget {args.budget_ms:.0f} ms)")
+        
+        eager = [name for name in LAZY_MODULES if name in last]
+        if eager:
+            print(f"❌ imported at startup but should load on first use: {', '.join(eager)}")
+            failed = True
+        if median > args.budget_ms:
+            print(f"❌ over budget by {median - args.budget_ms:.1f} ms")
+            failed = True
+    if not failed:
+        print("\n✅ within budget")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
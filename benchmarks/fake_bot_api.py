@@ -0,0 +1,287 @@
+"""
+A local stand-in for the Telegram Bot API, enough to run the bot against it.
+
+Point the bot at it with BOT_API_URL. Updates injected with send_update()
+are handed out through getUpdates, or pushed to the webhook once the bot
+calls setWebhook. Files registered with add_file() are served the way
+api.telegram.org/file/bot<token>/ serves them, and every call the bot
+makes is recorded per chat so a load generator can wait for the replies.
+"""
+import json
+import time
+import asyncio
+import logging
+from itertools import count
+from collections import defaultdict
+from aiohttp import web, ClientSession, ClientError
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {'id': 1000000001, 'is_bot': True, 'first_name': 'YoThumb', 'username': 'yothumb_load_bot'}
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+class BotAPIError(Exception):
+    def __init__(self, code, description):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+
+class Call:
+    """One request the bot made"""
+    __slots__ = ('method', 'params', 'result', 'at')
+    
+    def __init__(self, method, params, result):
+        self.method = method
+        self.params = params
+        self.result = result
+        self.at = time.monotonic()
+
+class FakeBotAPI:
+    def __init__(self, token, host='127.0.0.1', port=0):
+        self.token = token
+        self.host = host
+        self.port = port
+        self.files = {}
+        self.updates = []
+        self.webhook = None
+        self.calls = defaultdict(asyncio.Queue)
+        self.method_counts = defaultdict(int)
+        self.bytes_uploaded = 0
+        self.ready = asyncio.Event()
+        self._new_update = asyncio.Condition()
+        self._update_ids = count(1)
+        self._message_ids = count(1)
+        self._file_ids = count(1)
+        self._runner = None
+        self._session = None
+        self._webhook_slots = None
+    
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+    
+    async def start(self):
+        app = web.Application(client_max_size=2 * 1024 ** 3)
+        app.router.add_post('/bot{token}/{method}', self.handle_method)
+        app.router.add_get('/bot{token}/{method}', self.handle_method)
+        app.router.add_get('/file/bot{token}/{path:.+}', self.handle_file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._session = ClientSession()
+    
+    async def stop(self):
+        if self._session:
+            await self._session.close()
+        if self._runner:
+            await self._runner.cleanup()
+    
+    # --- what the users do ---
+    
+    def add_file(self, path, file_path, size, file_unique_id=None):
+        """Register a local file, returns its file_id"""
+        file_id = f"file{next(self._file_ids)}"
+        self.files[file_id] = {
+            'path': path,
+            'file_path': file_path,
+            'file_size': size,
+            'file_unique_id': file_unique_id or f"unique{file_id}",
+        }
+        return file_id
+    
+    def file_object(self, file_id):
+        entry = self.files[file_id]
+        return {'file_id': file_id, 'file_unique_id': entry['file_unique_id'], 'file_size': entry['file_size']}
+    
+    def message(self, chat_id, **fields):
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': f"user{chat_id}"},
+            **fields,
+        }
+    
+    async def send_update(self, user_id, **message_fields):
+        """A user message to the bot, returns when it was handed over"""
+        message = self.message(user_id, **message_fields)
+        message['from'] = {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+        update = {'update_id': next(self._update_ids), 'message': message}
+        
+        if self.webhook:
+            await self._push(update)
+        else:
+            async with self._new_update:
+                self.updates.append(update)
+                self._new_update.notify_all()
+        return message
+    
+    async def _push(self, update):
+        url, secret = self.webhook
+        headers = {SECRET_HEADER: secret} if secret else {}
+        async with self._webhook_slots:
+            for attempt in range(5):
+                try:
+                    async with self._session.post(url, json=update, headers=headers) as response:
+                        if response.status == 200:
+                            return
+                        logger.warning(f"Webhook answered {response.status} to update {update['update_id']}")
+                except ClientError as e:
+                    logger.warning(f"Webhook delivery failed: {e}")
+                await asyncio.sleep(0.5 * (attempt + 1))
+    
+    async def next_call(self, chat_id, timeout=None):
+        """The next call the bot made in this chat"""
+        return await asyncio.wait_for(self.calls[chat_id].get(), timeout)
+    
+    # --- what the bot does ---
+    
+    async def handle_method(self, request):
+        method = request.match_info['method']
+        self.method_counts[method] += 1
+        if request.match_info['token'] != self.token:
+            return web.json_response({'ok': False, 'error_code': 401, 'description': 'Unauthorized'}, status=401)
+        
+        params = await self.read_params(request)
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None and method.startswith('send'):
+            handler = self.api_send
+        if handler is None:
+            return web.json_response(
+                {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}, status=404
+            )
+        
+        try:
+            result = await handler(method, params)
+        except BotAPIError as e:
+            return web.json_response({'ok': False, 'error_code': e.code, 'description': e.description}, status=e.code)
+        
+        chat_id = params.get('chat_id')
+        if chat_id is not None:
+            self.calls[int(chat_id)].put_nowait(Call(method, params, result))
+        return web.json_response({'ok': True, 'result': result})
+    
+    async def read_params(self, request):
+        """Parameters as python-telegram-bot sends them: form fields, JSON-encoded where not a plain string"""
+        if request.content_type.startswith('multipart/'):
+            params = {}
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename:
+                    # uploaded files are only counted
+                    size = 0
+                    while chunk := await part.read_chunk(1024 * 1024):
+                        size += len(chunk)
+                    self.bytes_uploaded += size
+                    params[part.name] = {'uploaded': part.filename, 'size': size}
+                else:
+                    params[part.name] = await part.text()
+        elif request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        
+        for key, value in params.items():
+            if isinstance(value, str) and value[:1] in '{[':
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    pass
+        return params
+    
+    async def handle_file(self, request):
+        if request.match_info['token'] != self.token:
+            return web.Response(status=401)
+        file_path = request.match_info['path']
+        for entry in self.files.values():
+            if entry['file_path'] == file_path:
+                return web.FileResponse(entry['path'])
+        return web.Response(status=404)
+    
+    async def api_getMe(self, method, params):
+        return BOT_USER
+    
+    async def api_getUpdates(self, method, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        limit = int(params.get('limit') or 100)
+        async with self._new_update:
+            # confirmed updates are dropped, like Telegram does
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            self.ready.set()
+            if not self.updates and timeout:
+                try:
+                    await asyncio.wait_for(self._new_update.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self.updates[:limit]
+    
+    async def api_setWebhook(self, method, params):
+        max_connections = int(params.get('max_connections') or 40)
+        self.webhook = (params['url'], params.get('secret_token'))
+        self._webhook_slots = asyncio.Semaphore(max_connections)
+        self.ready.set()
+        return True
+    
+    async def api_deleteWebhook(self, method, params):
+        self.webhook = None
+        return True
+    
+    async def api_getWebhookInfo(self, method, params):
+        url = self.webhook[0] if self.webhook else ''
+        return {'url': url, 'has_custom_certificate': False, 'pending_update_count': len(self.updates)}
+    
+    async def api_getFile(self, method, params):
+        entry = self.files.get(params.get('file_id'))
+        if entry is None:
+            raise BotAPIError(400, 'Bad Request: invalid file_id')
+        return {**self.file_object(params['file_id']), 'file_path': entry['file_path']}
+    
+    def media_object(self, kind, media, params):
+        """The sent file as Telegram describes it; an upload becomes a new file_id"""
+        if isinstance(media, dict):
+            file_id, size = f"file{next(self._file_ids)}", media['size']
+        else:
+            file_id, size = media, 0
+        entry = {'file_id': file_id, 'file_unique_id': f"unique{file_id}", 'file_size': size}
+        if kind == 'video':
+            entry.update({key: int(params.get(key) or 0) for key in ('width', 'height', 'duration')})
+        elif kind == 'photo':
+            return [{**entry, 'width': 0, 'height': 0}]
+        return entry
+    
+    async def api_send(self, method, params):
+        """sendMessage, sendVideo, sendDocument, ...: answered with the new message"""
+        chat_id = int(params['chat_id'])
+        fields = {key: params[key] for key in ('text', 'caption') if key in params}
+        kind = method[len('send'):].lower()
+        if kind in params:
+            fields[kind] = self.media_object(kind, params[kind], params)
+        return self.message(chat_id, **fields)
+    
+    async def api_sendMediaGroup(self, method, params):
+        chat_id = int(params['chat_id'])
+        messages = []
+        for item in params['media']:
+            media = item['media']
+            if media.startswith('attach://'):
+                media = params.get(media[len('attach://'):], {'size': 0})
+            fields = {item['type']: self.media_object(item['type'], media, item)}
+            if 'caption' in item:
+                fields['caption'] = item['caption']
+            messages.append(self.message(chat_id, **fields))
+        return messages
+    
+    async def api_editMessageText(self, method, params):
+        return self.message(int(params['chat_id']), text=params['text']) | {'message_id': int(params['message_id'])}
+    
+    async def api_editMessageCaption(self, method, params):
+        fields = {'caption': params.get('caption', '')}
+        return self.message(int(params['chat_id']), **fields) | {'message_id': int(params['message_id'])}
+    
+    async def api_deleteMessage(self, method, params):
+        return True
+    
+    async def api_sendChatAction(self, method, params):
+        return True
@@ -0,0 +1,197 @@
+"""
+A local stand-in for the Google Drive v3 API, enough to run bot/gdrive.py against it.
+
+Point the bot at it with GDRIVE_API_URL=<url>/ and a service
+account whose token_uri is <url>/token (see service_account()). It serves
+resumable uploads the way Drive does: the session starts with a POST, every
+chunk PUT is answered with 308 and the Range acknowledged so far, and an
+empty PUT with "Content-Range: bytes */<size>" asks where to resume. Files
+can then be shared and listed.
+
+inject_failures() makes chunk PUTs fail with an error status partway through
+an upload, after keeping only part of the chunk, the way an interrupted
+upload looks to the client.
+"""
+import re
+import time
+from itertools import count
+from aiohttp import web
+
+ACCESS_TOKEN = 'fake-drive-token'
+CONTENT_RANGE = re.compile(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)')
+
+def service_account(token_uri):
+    """Service account credentials for GOOGLE_CREDENTIALS_JSON, signed with a throwaway key"""
+    import rsa
+    _, private_key = rsa.newkeys(1024)
+    return {
+        'type': 'service_account',
+        'project_id': 'benchmark',
+        'private_key_id': 'benchmark',
+        'private_key': private_key.save_pkcs1().decode(),
+        'client_email': 'benchmark@benchmark.iam.gserviceaccount.com',
+        'client_id': '1',
+        'token_uri': token_uri,
+    }
+
+def error_response(status, message):
+    return web.json_response({'error': {'code': status, 'message': message}}, status=status)
+
+class FakeDriveAPI:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.files = {}
+        self.sessions = {}
+        self.token_requests = 0
+        self.chunk_puts = 0
+        self.status_queries = 0
+        self.failures_injected = 0
+        self.bytes_received = 0
+        self._fail_status = None
+        self._fail_every = 0
+        self._fail_burst = 0
+        self._file_ids = count(1)
+        self._session_ids = count(1)
+        self._runner = None
+    
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+    
+    async def start(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post('/token', self.handle_token)
+        app.router.add_post('/upload/drive/v3/files', self.handle_upload_start)
+        app.router.add_put('/upload/drive/v3/files', self.handle_upload_chunk)
+        app.router.add_post('/drive/v3/files/{file_id}/permissions', self.handle_permission)
+        app.router.add_get('/drive/v3/files', self.handle_list)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+    
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+    
+    def inject_failures(self, status=503, every=3, burst=1):
+        """In every upload, after each `every` chunks that went through, fail the next `burst` chunk PUTs with status"""
+        self._fail_status = status
+        self._fail_every = every
+        self._fail_burst = burst
+    
+    def _should_fail(self, session):
+        if not self._fail_status:
+            return False
+        return (session['puts'] - 1) % (self._fail_every + self._fail_burst) >= self._fail_every
+    
+    # --- what the bot does ---
+    
+    def _authorized(self, request):
+        return request.headers.get('Authorization') == f"Bearer {ACCESS_TOKEN}"
+    
+    async def handle_token(self, request):
+        self.token_requests += 1
+        return web.json_response({'access_token': ACCESS_TOKEN, 'expires_in': 3600, 'token_type': 'Bearer'})
+    
+    async def handle_upload_start(self, request):
+        if not self._authorized(request):
+            return error_response(401, 'Invalid Credentials')
+        if request.query.get('uploadType') != 'resumable':
+            return error_response(400, 'Only resumable uploads are supported')
+        metadata = await request.json() if request.can_read_body else {}
+        session_id = f"session{next(self._session_ids)}"
+        self.sessions[session_id] = {'metadata': metadata, 'data': bytearray(), 'puts': 0}
+        location = f"{self.url}/upload/drive/v3/files?uploadType=resumable&upload_id={session_id}"
+        return web.Response(status=200, headers={'Location': location})
+    
+    async def handle_upload_chunk(self, request):
+        session = self.sessions.get(request.query.get('upload_id'))
+        if session is None:
+            return error_response(404, 'Upload session not found')
+        match = CONTENT_RANGE.fullmatch(request.headers.get('Content-Range', ''))
+        if match is None:
+            return error_response(400, 'Invalid Content-Range')
+        first, last, total = match.groups()
+        data = session['data']
+        
+        if first is None:
+            # where should the client resume?
+            self.status_queries += 1
+            if 'file_id' in session:
+                return web.json_response(self.files[session['file_id']]['resource'])
+            return self._resume_incomplete(data)
+        
+        body = await request.read()
+        self.bytes_received += len(body)
+        first, last = int(first), int(last)
+        if first > len(data) or last - first + 1 != len(body):
+            return error_response(400, f"Chunk {first}-{last} does not continue the {len(data)} bytes received")
+        
+        self.chunk_puts += 1
+        session['puts'] += 1
+        if self._should_fail(session):
+            # only part of the chunk made it before the error
+            self.failures_injected += 1
+            data[first:] = body[:len(body) // 2]
+            return error_response(self._fail_status, 'Backend Error')
+        
+        data[first:] = body
+        if total == '*' or len(data) < int(total):
+            return self._resume_incomplete(data)
+        return web.json_response(self._create_file(session))
+    
+    def _resume_incomplete(self, data):
+        headers = {'Range': f"bytes=0-{len(data) - 1}"} if data else {}
+        return web.Response(status=308, headers=headers)
+    
+    def _create_file(self, session):
+        file_id = f"file{next(self._file_ids)}"
+        metadata = session['metadata']
+        resource = {
+            'id': file_id,
+            'name': metadata.get('name', 'Untitled'),
+            'createdTime': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+            'size': str(len(session['data'])),
+            'webViewLink': f"{self.url}/file/d/{file_id}/view",
+            'webContentLink': f"{self.url}/uc?id={file_id}&export=download",
+        }
+        self.files[file_id] = {
+            'resource': resource,
+            'parents': metadata.get('parents', []),
+            'data': bytes(session['data']),
+            'permissions': [],
+        }
+        session['file_id'] = file_id
+        return resource
+    
+    async def handle_permission(self, request):
+        if not self._authorized(request):
+            return error_response(401, 'Invalid Credentials')
+        entry = self.files.get(request.match_info['file_id'])
+        if entry is None:
+            return error_response(404, 'File not found')
+        permission = await request.json()
+        entry['permissions'].append(permission)
+        return web.json_response({'id': 'anyoneWithLink', **permission})
+    
+    async def handle_list(self, request):
+        """Newest first, only the "'<folder>' in parents" query the bot uses"""
+        if not self._authorized(request):
+            return error_response(401, 'Invalid Credentials')
+        entries = list(self.files.values())[::-1]
+        query = request.query.get('q')
+        if query:
+            match = re.fullmatch(r"'(.+)' in parents", query)
+            if match is None:
+                return error_response(400, f"Unsupported query: {query}")
+            entries = [entry for entry in entries if match.group(1) in entry['parents']]
+        
+        start = int(request.query.get('pageToken') or 0)
+        page_size = int(request.query.get('pageSize', 100))
+        result = {'files': [entry['resource'] for entry in entries[start:start + page_size]]}
+        if start + page_size < len(entries):
+            result['nextPageToken'] = str(start + page_size)
+        return web.json_response(result)
@@ -1,5 +1,6 @@
 import os
 import json
+import hashlib
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -8,11 +9,46 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 OWNER_ID = os.getenv('OWNER_ID')
 SUPPORT_USERNAME = os.getenv('SUPPORT_USERNAME', 'YourUsername')
+BOT_API_URL = os.getenv('BOT_API_URL')
+
+# Webhook Configuration (polling when WEBHOOK_URL is not set)
+PORT = int(os.getenv('PORT', 10000))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 16))
+HEALTH_MAX_LOOP_LAG = float(os.getenv('HEALTH_MAX_LOOP_LAG', 2))
+HEALTH_MIN_FREE_MB = int(os.getenv('HEALTH_MIN_FREE_MB', 200))
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', 0.5))
+SLOW_HANDLER_THRESHOLD = float(os.getenv('SLOW_HANDLER_THRESHOLD', 10))
+
+# Database Configuration
+DATABASE_FILE = os.getenv('DATABASE_FILE', 'database.db')
+STATS_FLUSH_INTERVAL = int(os.getenv('STATS_FLUSH_INTERVAL', 30))
+STATS_FLUSH_THRESHOLD = int(os.getenv('STATS_FLUSH_THRESHOLD', 50))
 
 # Google Drive Configuration
 GDRIVE_ENABLED = os.getenv('GDRIVE_ENABLED', 'false').lower() == 'true'
 GOOGLE_CREDENTIALS_JSON = os.getenv('GOOGLE_CREDENTIALS_JSON')
 GDRIVE_FOLDER_ID = os.getenv('GDRIVE_FOLDER_ID')
+GDRIVE_API_URL = os.getenv('GDRIVE_API_URL')
+GDRIVE_CHUNK_MB = int(os.getenv('GDRIVE_CHUNK_MB', 8))
+GDRIVE_MAX_UPLOADS = int(os.getenv('GDRIVE_MAX_UPLOADS', 2))
+GDRIVE_MAX_RETRIES = int(os.getenv('GDRIVE_MAX_RETRIES', 5))
+
+# Video Processing Configuration
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', os.cpu_count() or 1))
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 2))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 2))
+PIPELINE_BUFFER_SIZE = int(os.getenv('PIPELINE_BUFFER_SIZE', 1))
+SCRATCH_BUDGET_MB = int(os.getenv('SCRATCH_BUDGET_MB', 0))
+STREAM_DOWNLOADS = os.getenv('STREAM_DOWNLOADS', 'true').lower() == 'true'
+THUMB_CACHE_DIR = os.getenv('THUMB_CACHE_DIR', 'cache/thumbnails')
+THUMB_CACHE_MAX_MB = int(os.getenv('THUMB_CACHE_MAX_MB', 50))
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 1000))
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 7 * 86400))
+ALBUM_COLLECT_SECONDS = float(os.getenv('ALBUM_COLLECT_SECONDS', 1.5))
+USER_STATE_IDLE_HOURS = float(os.getenv('USER_STATE_IDLE_HOURS', 24))
 
 # Validate required variables
 if not BOT_TOKEN:
@@ -20,6 +56,10 @@ if not BOT_TOKEN:
 if not OWNER_ID:
     raise ValueError("❌ OWNER_ID not found in environment variables!")
 
+# Same secret on every replica, Telegram allows A-Z, a-z, 0-9, _ and -
+if not WEBHOOK_SECRET:
+    WEBHOOK_SECRET = hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+
 # Parse Google credentials if provided
 GOOGLE_CREDENTIALS = None
 if GOOGLE_CREDENTIALS_JSON and GDRIVE_ENABLED:
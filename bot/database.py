@@ -1,104 +1,327 @@
 import json
 import os
+import time
+import heapq
+import sqlite3
+import logging
 from datetime import datetime, timedelta
+from bot.config import DATABASE_FILE, STATS_FLUSH_THRESHOLD
+from bot.metrics import DB_WRITE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscriptions (
+    user_id INTEGER PRIMARY KEY,
+    expires_at TEXT NOT NULL,
+    activated_at TEXT NOT NULL,
+    videos_processed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS auth_keys (
+    key TEXT PRIMARY KEY,
+    duration_seconds INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0,
+    used_by INTEGER,
+    used_at TEXT
+);
+CREATE TABLE IF NOT EXISTS drive_backups (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_path TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    caption TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO stats (name, value) VALUES
+    ('total_users', 0),
+    ('total_videos', 0),
+    ('total_keys_generated', 0);
+"""
+
+class Subscription:
+    """Cached subscription row with the expiry pre-parsed to an epoch timestamp"""
+    
+    __slots__ = ('user_id', 'expires_ts', 'activated_at', 'videos_processed')
+    
+    def __init__(self, user_id, expires_ts, activated_at, videos_processed):
+        self.user_id = user_id
+        self.expires_ts = expires_ts
+        self.activated_at = activated_at
+        self.videos_processed = videos_processed
+    
+    @classmethod
+    def from_row(cls, user_id, row):
+        expires_ts = datetime.fromisoformat(row['expires_at']).timestamp()
+        return cls(user_id, expires_ts, row['activated_at'], row['videos_processed'])
+    
+    @property
+    def expires_at(self):
+        return datetime.fromtimestamp(self.expires_ts)
+    
+    def is_active(self, now=None):
+        return self.expires_ts > (now if now is not None else time.time())
 
 class Database:
-    def __init__(self):
-        self.db_file = 'database.json'
-        self.data = self.load_data()
-    
-    def load_data(self):
-        if os.path.exists(self.db_file):
-            try:
-                with open(self.db_file, 'r') as f:
-                    return json.load(f)
-            except:
-                return self.get_default_data()
-        return self.get_default_data()
-    
-    def get_default_data(self):
-        return {
-            'subscriptions': {},
-            'auth_keys': {},
-            'stats': {
-                'total_users': 0,
-                'total_videos': 0,
-                'total_keys_generated': 0
-            }
-        }
-    
-    def save_data(self):
+    def __init__(self, db_file=DATABASE_FILE, json_file='database.json'):
+        self.db_file = db_file
+        self.json_file = json_file
+        # user_id -> Subscription, or None for users known to have no subscription
+        self._subscriptions = {}
+        self._expiry_heap = []
+        # user_id -> videos processed since the last flush
+        self._pending_videos = {}
+        self._pending_count = 0
+        self.conn = sqlite3.connect(
+            db_file,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.migrate_from_json()
+    
+    def transaction(self):
+        return Transaction(self.conn)
+    
+    def migrate_from_json(self):
+        """Import the old database.json once, then rename it out of the way"""
+        if not os.path.exists(self.json_file):
+            return
         try:
-            with open(self.db_file, 'w') as f:
-                json.dump(self.data, f, indent=2)
+            with open(self.json_file, 'r') as f:
+                data = json.load(f)
         except Exception as e:
-            print(f"Error saving database: {e}")
+            logger.error(f"Could not read {self.json_file} for migration: {e}")
+            return
+        
+        with self.transaction() as cur:
+            cur.executemany(
+                "INSERT OR REPLACE INTO subscriptions (user_id, expires_at, activated_at, videos_processed) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (int(user_id), sub['expires_at'], sub.get('activated_at', sub['expires_at']),
+                     sub.get('videos_processed', 0))
+                    for user_id, sub in data.get('subscriptions', {}).items()
+                ]
+            )
+            cur.executemany(
+                "INSERT OR REPLACE INTO auth_keys (key, duration_seconds, created_at, used, used_by, used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (key, key_data['duration_seconds'], key_data.get('created_at', ''),
+                     int(bool(key_data.get('used'))),
+                     int(key_data['used_by']) if key_data.get('used_by') else None,
+                     key_data.get('used_at'))
+                    for key, key_data in data.get('auth_keys', {}).items()
+                ]
+            )
+            cur.executemany(
+                "UPDATE stats SET value = ? WHERE name = ?",
+                [(value, name) for name, value in data.get('stats', {}).items()]
+            )
+        
+        os.replace(self.json_file, self.json_file + '.migrated')
+        logger.info(f"Migrated {self.json_file} to {self.db_file}")
     
     def create_auth_key(self, key, duration_seconds):
-        self.data['auth_keys'][key] = {
-            'duration_seconds': duration_seconds,
-            'created_at': datetime.now().isoformat(),
-            'used': False,
-            'used_by': None,
-            'used_at': None
-        }
-        self.data['stats']['total_keys_generated'] += 1
-        self.save_data()
-    
-    def verify_auth_key(self, key):
-        if key in self.data['auth_keys'] and not self.data['auth_keys'][key]['used']:
-            self.data['auth_keys'][key]['used'] = True
-            self.data['auth_keys'][key]['used_at'] = datetime.now().isoformat()
-            self.save_data()
-            return self.data['auth_keys'][key]
-        return None
+        with self.transaction() as cur:
+            cur.execute(
+                "INSERT INTO auth_keys (key, duration_seconds, created_at) VALUES (?, ?, ?)",
+                (key, duration_seconds, datetime.now().isoformat())
+            )
+            cur.execute("UPDATE stats SET value = value + 1 WHERE name = 'total_keys_generated'")
+    
+    def redeem_auth_key(self, key, user_id):
+        """Mark an unused key as used by user_id and extend their subscription.
+
+        Everything happens in one transaction, so a key can only ever be
+        redeemed once. Returns the key data with the new expiry, or None if
+        the key does not exist or was already used.
+        """
+        now = datetime.now()
+        with self.transaction() as cur:
+            updated = cur.execute(
+                "UPDATE auth_keys SET used = 1, used_by = ?, used_at = ? WHERE key = ? AND used = 0",
+                (user_id, now.isoformat(), key)
+            ).rowcount
+            if not updated:
+                return None
+            row = cur.execute("SELECT * FROM auth_keys WHERE key = ?", (key,)).fetchone()
+            key_data = self._key_dict(row)
+            key_data['expires_at'] = self._extend_subscription(
+                cur, user_id, key_data['duration_seconds'], now
+            ).isoformat()
+        return key_data
     
     def activate_subscription(self, user_id, duration_seconds):
-        user_id_str = str(user_id)
+        with self.transaction() as cur:
+            self._extend_subscription(cur, user_id, duration_seconds, datetime.now())
+    
+    def _extend_subscription(self, cur, user_id, duration_seconds, now):
+        row = cur.execute(
+            "SELECT expires_at FROM subscriptions WHERE user_id = ?", (user_id,)
+        ).fetchone()
         
-        if user_id_str in self.data['subscriptions']:
-            current_expires = datetime.fromisoformat(
-                self.data['subscriptions'][user_id_str]['expires_at']
-            )
-            if current_expires > datetime.now():
+        if row:
+            current_expires = datetime.fromisoformat(row['expires_at'])
+            if current_expires > now:
                 new_expires = current_expires + timedelta(seconds=duration_seconds)
             else:
-                new_expires = datetime.now() + timedelta(seconds=duration_seconds)
+                new_expires = now + timedelta(seconds=duration_seconds)
         else:
-            new_expires = datetime.now() + timedelta(seconds=duration_seconds)
-            self.data['stats']['total_users'] += 1
-        
-        self.data['subscriptions'][user_id_str] = {
-            'expires_at': new_expires.isoformat(),
-            'activated_at': datetime.now().isoformat(),
-            'videos_processed': self.data['subscriptions'].get(user_id_str, {}).get('videos_processed', 0)
-        }
-        
-        for key, key_data in self.data['auth_keys'].items():
-            if key_data.get('used') and not key_data.get('used_by'):
-                key_data['used_by'] = user_id_str
-                break
+            new_expires = now + timedelta(seconds=duration_seconds)
+            cur.execute("UPDATE stats SET value = value + 1 WHERE name = 'total_users'")
         
-        self.save_data()
+        cur.execute(
+            "INSERT INTO subscriptions (user_id, expires_at, activated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET "
+            "expires_at = excluded.expires_at, activated_at = excluded.activated_at",
+            (user_id, new_expires.isoformat(), now.isoformat())
+        )
+        self._subscriptions.pop(user_id, None)
+        return new_expires
     
     def get_subscription(self, user_id):
-        user_id_str = str(user_id)
-        return self.data['subscriptions'].get(user_id_str)
+        try:
+            return self._subscriptions[user_id]
+        except KeyError:
+            pass
+        
+        row = self.conn.execute(
+            "SELECT expires_at, activated_at, videos_processed FROM subscriptions WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+        subscription = Subscription.from_row(user_id, row) if row else None
+        if subscription:
+            subscription.videos_processed += self._pending_videos.get(user_id, 0)
+        self._subscriptions[user_id] = subscription
+        if subscription:
+            heapq.heappush(self._expiry_heap, (subscription.expires_ts, user_id))
+        return subscription
     
     def has_active_subscription(self, user_id):
         subscription = self.get_subscription(user_id)
-        if not subscription:
-            return False
-        expires_at = datetime.fromisoformat(subscription['expires_at'])
-        return expires_at > datetime.now()
-    
-    def increment_videos_processed(self, user_id):
-        user_id_str = str(user_id)
-        if user_id_str in self.data['subscriptions']:
-            self.data['subscriptions'][user_id_str]['videos_processed'] = \
-                self.data['subscriptions'][user_id_str].get('videos_processed', 0) + 1
-            self.data['stats']['total_videos'] += 1
-            self.save_data()
+        return subscription is not None and subscription.expires_ts > time.time()
+    
+    def evict_expired(self):
+        """Drop expired and negative entries from the cache, returns how many were evicted"""
+        now = time.time()
+        evicted = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_ts, user_id = heapq.heappop(self._expiry_heap)
+            subscription = self._subscriptions.get(user_id)
+            if subscription is not None and subscription.expires_ts == expires_ts:
+                del self._subscriptions[user_id]
+                evicted += 1
+        
+        unknown = [user_id for user_id, subscription in self._subscriptions.items() if subscription is None]
+        for user_id in unknown:
+            del self._subscriptions[user_id]
+        return evicted + len(unknown)
+    
+    def increment_videos_processed(self, user_id, count=1):
+        """Count processed videos; the write is batched until the next flush()"""
+        subscription = self.get_subscription(user_id)
+        if subscription is None:
+            return
+        subscription.videos_processed += count
+        self._pending_videos[user_id] = self._pending_videos.get(user_id, 0) + count
+        self._pending_count += count
+        if self._pending_count >= STATS_FLUSH_THRESHOLD:
+            self.flush()
+    
+    def flush(self):
+        """Write all batched counter increments in a single transaction"""
+        if not self._pending_videos:
+            return
+        pending = self._pending_videos
+        try:
+            with self.transaction() as cur:
+                total = 0
+                for user_id, count in pending.items():
+                    if cur.execute(
+                        "UPDATE subscriptions SET videos_processed = videos_processed + ? WHERE user_id = ?",
+                        (count, user_id)
+                    ).rowcount:
+                        total += count
+                cur.execute("UPDATE stats SET value = value + ? WHERE name = 'total_videos'", (total,))
+        except sqlite3.Error as e:
+            logger.error(f"Error flushing stats: {e}")
+            return
+        self._pending_videos = {}
+        self._pending_count = 0
+    
+    def add_backup(self, file_path, file_name, chat_id, message_id, caption):
+        with self.transaction() as cur:
+            cur.execute(
+                "INSERT INTO drive_backups (file_path, file_name, chat_id, message_id, caption, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (file_path, file_name, chat_id, message_id, caption, datetime.now().isoformat())
+            )
+            return cur.lastrowid
+    
+    def get_backup(self, backup_id):
+        row = self.conn.execute("SELECT * FROM drive_backups WHERE id = ?", (backup_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def pending_backups(self):
+        rows = self.conn.execute("SELECT * FROM drive_backups ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+    
+    def backup_attempt_failed(self, backup_id):
+        """Count a failed upload, returns the number of attempts so far"""
+        with self.transaction() as cur:
+            cur.execute("UPDATE drive_backups SET attempts = attempts + 1 WHERE id = ?", (backup_id,))
+            row = cur.execute("SELECT attempts FROM drive_backups WHERE id = ?", (backup_id,)).fetchone()
+        return row['attempts'] if row else 0
+    
+    def remove_backup(self, backup_id):
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM drive_backups WHERE id = ?", (backup_id,))
     
     def get_stats(self):
-        return self.data['stats']
+        rows = self.conn.execute("SELECT name, value FROM stats").fetchall()
+        stats = {row['name']: row['value'] for row in rows}
+        stats['total_videos'] += self._pending_count
+        return stats
+    
+    def close(self):
+        self.flush()
+        self.conn.close()
+    
+    @staticmethod
+    def _key_dict(row):
+        key_data = dict(row)
+        key_data['used'] = bool(key_data['used'])
+        if key_data['used_by'] is not None:
+            key_data['used_by'] = str(key_data['used_by'])
+        return key_data
+
+class Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back if the block raises"""
+    
+    def __init__(self, conn):
+        self.conn = conn
+    
+    def __enter__(self):
+        self.started = time.monotonic()
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn.cursor()
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        DB_WRITE_SECONDS.observe(time.monotonic() - self.started)
+        return False
@@ -0,0 +1,145 @@
+import os
+import asyncio
+import logging
+from telegram.error import TelegramError
+from bot.config import GDRIVE_MAX_UPLOADS
+from bot.tempfiles import remove_file
+from bot.scratch import scratch_space
+from bot.metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIRECTORY = 'backups'
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 60
+
+class DriveBackupQueue:
+    """Uploads processed videos to Google Drive after the user already got them.
+
+    Pending backups are stored in the database and their files are moved to
+    backups/, out of reach of the temp file sweep, so they survive restarts.
+    Once uploaded, the caption of the sent video is edited to add the link.
+    Their size counts against the scratch space budget until then.
+    Without a gdrive client, one is built on the first upload.
+    """
+    
+    def __init__(self, db, gdrive=None, workers=GDRIVE_MAX_UPLOADS, directory=BACKUP_DIRECTORY, scratch=scratch_space):
+        self.db = db
+        self.gdrive = gdrive
+        self._gdrive_lock = asyncio.Lock()
+        self.workers = workers
+        self.directory = directory
+        self.scratch = scratch
+        self.bot = None
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        self._retries = set()
+    
+    def __len__(self):
+        return self._queue.qsize() + len(self._retries)
+    
+    async def start(self, bot):
+        self.bot = bot
+        os.makedirs(self.directory, exist_ok=True)
+        for backup in self.db.pending_backups():
+            if os.path.exists(backup['file_path']):
+                self.scratch.claim(scratch_owner(backup['id']), os.path.getsize(backup['file_path']))
+            self._queue.put_nowait(backup['id'])
+        if self._queue.qsize():
+            logger.info(f"☁️ Resuming {self._queue.qsize()} pending Drive backups")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        tasks = self._tasks + list(self._retries)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+    
+    def enqueue(self, file_path, file_name, message, caption):
+        """Take ownership of file_path and back it up in the background"""
+        backup_path = os.path.join(self.directory, os.path.basename(file_path))
+        os.replace(file_path, backup_path)
+        backup_id = self.db.add_backup(backup_path, file_name, message.chat_id, message.message_id, caption)
+        # the job's reservation is released next, the file keeps its share
+        self.scratch.claim(scratch_owner(backup_id), os.path.getsize(backup_path))
+        self._queue.put_nowait(backup_id)
+        return backup_id
+    
+    async def _worker(self):
+        while True:
+            backup_id = await self._queue.get()
+            backup = self.db.get_backup(backup_id)
+            if backup is None:
+                continue
+            if not os.path.exists(backup['file_path']):
+                logger.warning(f"Drive backup {backup_id}: {backup['file_path']} is gone, dropping it")
+                await self._remove(backup)
+                continue
+            try:
+                gdrive = await self._client()
+                with STAGE_SECONDS.time(stage='drive_upload'):
+                    link = await gdrive.upload_file(backup['file_path'], f"processed_{backup['file_name']}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await self._failed(backup, e)
+                continue
+            
+            await self._send_link(backup, link)
+            await self._remove(backup)
+    
+    async def _client(self):
+        async with self._gdrive_lock:
+            if self.gdrive is None:
+                # importing googleapiclient and building the service takes a while, keep it off startup and the loop
+                self.gdrive = await asyncio.get_running_loop().run_in_executor(None, build_gdrive)
+                logger.info("☁️ Google Drive client ready")
+        return self.gdrive
+    
+    async def _remove(self, backup):
+        self.db.remove_backup(backup['id'])
+        remove_file(backup['file_path'])
+        await self.scratch.release(scratch_owner(backup['id']))
+    
+    async def _failed(self, backup, error):
+        attempts = self.db.backup_attempt_failed(backup['id'])
+        if attempts >= MAX_ATTEMPTS:
+            logger.error(f"Drive backup {backup['id']} failed {attempts} times, giving up: {error}")
+            await self._remove(backup)
+            return
+        delay = RETRY_DELAY * attempts
+        logger.warning(f"Drive backup {backup['id']} failed ({error}), retrying in {delay}s")
+        task = asyncio.create_task(self._retry(backup['id'], delay))
+        self._retries.add(task)
+        task.add_done_callback(self._retries.discard)
+    
+    async def _retry(self, backup_id, delay):
+        await asyncio.sleep(delay)
+        self._queue.put_nowait(backup_id)
+    
+    async def _send_link(self, backup, link):
+        if not link:
+            return
+        line = f"☁️ [Download from Google Drive]({link})"
+        try:
+            await self.bot.edit_message_caption(
+                chat_id=backup['chat_id'],
+                message_id=backup['message_id'],
+                caption=f"{backup['caption']}\n\n{line}",
+                parse_mode='Markdown'
+            )
+        except TelegramError as e:
+            # the video message was deleted or is too old to edit
+            logger.info(f"Could not edit caption for backup {backup['id']}: {e}")
+            try:
+                await self.bot.send_message(backup['chat_id'], line, parse_mode='Markdown')
+            except TelegramError as e:
+                logger.error(f"Could not send Drive link for backup {backup['id']}: {e}")
+
+def build_gdrive():
+    from bot.gdrive import GDrive
+    return GDrive()
+
+def scratch_owner(backup_id):
+    return f"backup:{backup_id}"
@@ -1,9 +1,29 @@
-import io
 import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httplib2
+import google_auth_httplib2
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload, build_http
 from bot.config import GOOGLE_CREDENTIALS, GDRIVE_FOLDER_ID, GDRIVE_ENABLED
+from bot.config import GDRIVE_API_URL, GDRIVE_CHUNK_MB, GDRIVE_MAX_UPLOADS, GDRIVE_MAX_RETRIES
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# backoff after the n-th failed attempt: RETRY_DELAY * 2**n seconds, at most MAX_RETRY_DELAY
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+FOLDER_INDEX_TTL = 300
+PAGE_SIZE = 1000
+FILE_FIELDS = ('id', 'name', 'createdTime', 'size')
 
 class GDrive:
     def __init__(self):
@@ -15,8 +35,43 @@ class GDrive:
             scopes=['https://www.googleapis.com/auth/drive.file']
         )
         
-        self.service = build('drive', 'v3', credentials=self.credentials)
+        self.service = build_service(self.credentials)
         self.folder_id = GDRIVE_FOLDER_ID
+        self.chunk_size = GDRIVE_CHUNK_MB * 1024 * 1024
+        
+        # httplib2 is not thread-safe, every executor thread gets its own connection;
+        # they all share self.credentials, so the access token is refreshed once
+        self._executor = ThreadPoolExecutor(max_workers=GDRIVE_MAX_UPLOADS, thread_name_prefix='gdrive')
+        self._upload_slots = asyncio.Semaphore(GDRIVE_MAX_UPLOADS)
+        self._local = threading.local()
+        self._index = None
+        self._index_time = 0
+        self._index_lock = threading.Lock()
+    
+    def _http(self):
+        if not hasattr(self._local, 'http'):
+            self._local.http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=build_http())
+        return self._local.http
+    
+    async def _call(self, func, *args):
+        """Run a blocking API call in the Drive executor, retrying transient failures"""
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            try:
+                return await loop.run_in_executor(self._executor, func, *args)
+            except HttpError as e:
+                if e.resp.status not in RETRYABLE_STATUSES or attempt >= GDRIVE_MAX_RETRIES:
+                    raise
+                error = e
+            except (OSError, httplib2.HttpLib2Error) as e:
+                if attempt >= GDRIVE_MAX_RETRIES:
+                    raise
+                error = e
+            attempt += 1
+            delay = min(RETRY_DELAY * 2 ** attempt, MAX_RETRY_DELAY)
+            logger.warning(f"Drive request failed ({error}), retry {attempt} in {delay}s")
+            await asyncio.sleep(delay)
     
     async def upload_file(self, file_path, file_name=None):
         if not file_name:
@@ -30,29 +85,68 @@ class GDrive:
         media = MediaFileUpload(
             file_path,
             mimetype='video/mp4',
+            chunksize=self.chunk_size,
             resumable=True
         )
         
-        file = self.service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id, webViewLink, webContentLink'
-        ).execute()
+        async with self._upload_slots:
+            request = self.service.files().create(
+                body=file_metadata,
+                media_body=media,
+                fields=', '.join(FILE_FIELDS + ('webViewLink', 'webContentLink'))
+            )
+            
+            # next_chunk() resumes from the last byte the server acknowledged after an error
+            file = None
+            while file is None:
+                _, file = await self._call(lambda: request.next_chunk(http=self._http()))
+            
+            permission = self.service.permissions().create(
+                fileId=file.get('id'),
+                body={'type': 'anyone', 'role': 'reader'}
+            )
+            await self._call(lambda: permission.execute(http=self._http()))
         
-        self.service.permissions().create(
-            fileId=file.get('id'),
-            body={'type': 'anyone', 'role': 'reader'}
-        ).execute()
+        with self._index_lock:
+            if self._index is not None:
+                self._index.insert(0, {field: file.get(field) for field in FILE_FIELDS})
         
         return file.get('webContentLink') or file.get('webViewLink')
     
-    def list_files(self, max_results=10):
+    def iter_files(self, page_size=PAGE_SIZE):
+        """Yield the files in the backup folder newest first, fetching one page at a time (blocking)"""
         query = f"'{self.folder_id}' in parents" if self.folder_id else None
-        
-        results = self.service.files().list(
-            q=query,
-            pageSize=max_results,
-            fields="files(id, name, createdTime, size)"
-        ).execute()
-        
-        return results.get('files', [])
+        page_token = None
+        while True:
+            results = self.service.files().list(
+                q=query,
+                pageSize=page_size,
+                pageToken=page_token,
+                orderBy='createdTime desc',
+                fields=f"nextPageToken, files({', '.join(FILE_FIELDS)})"
+            ).execute(http=self._http())
+            yield from results.get('files', [])
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return
+    
+    def folder_index(self):
+        """All files in the backup folder, cached for FOLDER_INDEX_TTL seconds (blocking)"""
+        with self._index_lock:
+            if self._index is None or time.monotonic() - self._index_time > FOLDER_INDEX_TTL:
+                self._index = list(self.iter_files())
+                self._index_time = time.monotonic()
+            return self._index
+    
+    def list_files(self, max_results=10):
+        return self.folder_index()[:max_results]
+
+def build_service(credentials):
+    """The Drive v3 service, under GDRIVE_API_URL instead of Google's API root when set"""
+    # the discovery document bundled with googleapiclient, no network round trip
+    document = json.loads(discovery_cache.get_static_doc('drive', 'v3'))
+    if GDRIVE_API_URL:
+        # uploads (<root>upload/drive/v3/) move along with the root;
+        # client_options would send them to the new host but keep https
+        document['rootUrl'] = GDRIVE_API_URL.rstrip('/') + '/'
+    return build_from_document(document, credentials=credentials)
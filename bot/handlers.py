@@ -1,18 +1,43 @@
+import io
 import os
+import time
 import uuid
+import asyncio
+import logging
+import threading
 import secrets
 import string
-from datetime import datetime, timedelta
-from telegram import Update
+from datetime import datetime
+from contextlib import ExitStack
+from telegram import Update, InputMediaVideo
 from telegram.ext import ContextTypes
-from bot.database import Database
-from bot.video_processor import process_video_with_thumbnail
-from bot.gdrive import GDrive
+from bot.video_processor import process_video_with_thumbnail, process_stream_with_thumbnail, is_streamable
+from bot.job_queue import VideoJob, VideoJobQueue, Stage, VideoBatch, AlbumItem
+from bot.result_cache import result_cache
+from bot.thumb_cache import file_digest, thumbnail_cache
+from bot.scratch import scratch_space, ScratchSpaceError
+from bot.tempfiles import temp_files
+from bot.metrics import STAGE_SECONDS, JOB_SECONDS, JOBS, BYTES_PROCESSED
+from bot.profiling import sample_stacks, summarize_stacks
 from bot.config import OWNER_ID, SUPPORT_USERNAME, GDRIVE_ENABLED
+from bot.config import MAX_CONCURRENT_JOBS, DOWNLOAD_WORKERS, UPLOAD_WORKERS, PIPELINE_BUFFER_SIZE
+from bot.config import STREAM_DOWNLOADS, ALBUM_COLLECT_SECONDS
 
-db = Database()
-gdrive = GDrive() if GDRIVE_ENABLED else None
+logger = logging.getLogger(__name__)
+
+# set by setup() from main()
+db = None
+drive_backup = None
 user_states = {}
+# albums still collecting videos, by media_group_id
+pending_albums = {}
+album_collectors = set()
+
+def setup(database, backup_queue=None):
+    """Give the handlers the Database and Drive backup queue built in main()"""
+    global db, drive_backup
+    db = database
+    drive_backup = backup_queue
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -55,6 +80,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /status - Check subscription status
 /cancel - Cancel current operation
 /genkey <duration> - Generate auth key (admin only)
+/profile [seconds] - Profile the event loop (admin only)
 
 **Duration examples for /genkey:**
 • 1h = 1 hour
@@ -80,10 +106,10 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ No active subscription. Get an auth key to activate!")
         return
     
-    expires_at = datetime.fromisoformat(subscription['expires_at'])
+    expires_at = subscription.expires_at
     now = datetime.now()
     
-    if expires_at < now:
+    if not subscription.is_active():
         await update.message.reply_text("⏰ Your subscription has expired. Get a new auth key!")
         return
     
@@ -96,17 +122,14 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 ⏰ Time remaining: {days_left} days, {hours_left} hours
 📅 Expires: {expires_at.strftime('%Y-%m-%d %H:%M')}
-📊 Videos processed: {subscription.get('videos_processed', 0)}
+📊 Videos processed: {subscription.videos_processed}
 """
     await update.message.reply_text(status_text, parse_mode='Markdown')
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id in user_states:
-        if 'thumbnail' in user_states[user_id]:
-            thumb_path = user_states[user_id]['thumbnail']
-            if os.path.exists(thumb_path):
-                os.remove(thumb_path)
+        temp_files.release_owner(user_owner(user_id))
         del user_states[user_id]
     await update.message.reply_text("✅ Operation cancelled.")
 
@@ -161,19 +184,44 @@ Key expires after first use.
 """
     await update.message.reply_text(key_text, parse_mode='Markdown')
 
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    if user_id != int(OWNER_ID):
+        await update.message.reply_text("❌ Only admin can profile the bot!")
+        return
+    
+    try:
+        seconds = min(max(int(context.args[0]), 1), 120) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("❌ Usage: /profile [seconds]")
+        return
+    
+    await update.message.reply_text(f"🔬 Sampling the event loop for {seconds}s...")
+    # handlers run on the event loop thread, the sampler watches it from another one
+    loop_thread = threading.get_ident()
+    stacks = await asyncio.get_running_loop().run_in_executor(None, sample_stacks, loop_thread, seconds)
+    
+    folded = io.BytesIO(''.join(f"{stack} {count}\n" for stack, count in stacks.most_common()).encode())
+    folded.name = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded"
+    await update.message.reply_document(
+        document=folded,
+        caption=summarize_stacks(stacks)[:1024]
+    )
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text.strip()
     
     if len(text) == 12 and text.isalnum() and text.isupper():
-        key_data = db.verify_auth_key(text)
+        key_data = db.redeem_auth_key(text, user_id)
         if key_data:
-            db.activate_subscription(user_id, key_data['duration_seconds'])
             duration_str = format_duration(key_data['duration_seconds'])
+            expires_at = datetime.fromisoformat(key_data['expires_at'])
             await update.message.reply_text(
                 f"✅ **Subscription Activated!**\n\n"
                 f"⏰ Duration: {duration_str}\n"
-                f"📅 Valid until: {(datetime.now() + timedelta(seconds=key_data['duration_seconds'])).strftime('%Y-%m-%d %H:%M')}\n\n"
+                f"📅 Valid until: {expires_at.strftime('%Y-%m-%d %H:%M')}\n\n"
                 f"Now send me a thumbnail image to start!",
                 parse_mode='Markdown'
             )
@@ -194,20 +242,26 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         photo = update.message.photo[-1]
         file = await context.bot.get_file(photo.file_id)
         
-        thumb_path = f"downloads/thumb_{user_id}_{uuid.uuid4().hex[:8]}.jpg"
-        await file.download_to_drive(thumb_path)
+        thumb_path = temp_files.track(
+            f"downloads/thumb_{user_id}_{uuid.uuid4().hex[:8]}.jpg", user_owner(user_id)
+        )
+        try:
+            await file.download_to_drive(thumb_path)
+            thumb_hash = await asyncio.get_running_loop().run_in_executor(None, file_digest, thumb_path)
+        except Exception:
+            temp_files.release(thumb_path, user_owner(user_id))
+            raise
         
         if user_id in user_states and 'thumbnail' in user_states[user_id]:
-            old_thumb = user_states[user_id]['thumbnail']
-            if os.path.exists(old_thumb):
-                os.remove(old_thumb)
+            temp_files.release(user_states[user_id]['thumbnail'], user_owner(user_id))
         
-        user_states[user_id] = {'thumbnail': thumb_path}
+        user_states[user_id] = {'thumbnail': thumb_path, 'thumbnail_hash': thumb_hash, 'last_used': time.monotonic()}
         
         await update.message.reply_text(
             "✅ Thumbnail saved!\n\n"
             "📹 Now send me your video(s).\n"
-            "💡 You can send multiple videos with the same thumbnail."
+            "💡 You can send multiple videos with the same thumbnail.\n"
+            "🎞️ Videos sent as an album come back as one album."
         )
     except Exception as e:
         await update.message.reply_text(f"❌ Error saving thumbnail: {str(e)}")
@@ -223,62 +277,322 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Send a thumbnail image first!")
         return
     
-    status_msg = await update.message.reply_text("⏳ Processing video... Please wait.")
+    user_states[user_id]['last_used'] = time.monotonic()
+    video = update.message.video or update.message.document
+    result_key = (video.file_unique_id, user_states[user_id]['thumbnail_hash'])
+    
+    if update.message.media_group_id:
+        await add_to_album(update, context, video, result_key)
+        return
+    
+    cached = result_cache.get(result_key)
+    if cached:
+        await update.message.reply_video(
+            video=cached['file_id'],
+            caption=cached['caption'],
+            supports_streaming=True,
+            parse_mode='Markdown'
+        )
+        db.increment_videos_processed(user_id)
+        JOBS.inc(result='cached')
+        return
     
-    video_path = None
-    output_path = None
+    status_msg = await update.message.reply_text("🕒 Added to queue...")
     
+    thumb_path = user_states[user_id]['thumbnail']
+    job = VideoJob(user_id, update, context, status_msg, video, thumb_path)
+    job.result_key = result_key
+    temp_files.track(thumb_path, job.job_id)
+    video_queue.enqueue(job)
+
+async def add_to_album(update, context, video, result_key):
+    """Collect the videos of an album, they are queued together once no more arrive"""
+    user_id = update.effective_user.id
+    group_id = update.message.media_group_id
+    
+    batch = pending_albums.get(group_id)
+    if batch is None:
+        batch = pending_albums[group_id] = VideoBatch(user_id, update, context, user_states[user_id]['thumbnail'])
+        # the album keeps its thumbnail even if the user sends a new one meanwhile
+        temp_files.track(batch.thumbnail, batch.batch_id)
+        batch.status_msg = await update.message.reply_text("🎞️ Collecting album...")
+        collector = asyncio.create_task(queue_album(group_id))
+        album_collectors.add(collector)
+        collector.add_done_callback(album_collectors.discard)
+    batch.add(AlbumItem(update, video, result_key))
+
+async def queue_album(group_id):
+    batch = pending_albums[group_id]
+    # once its jobs are queued, the album is released by send_album()
+    handed_over = False
     try:
-        video = update.message.video or update.message.document
-        file = await context.bot.get_file(video.file_id)
-        
-        file_name = getattr(video, 'file_name', 'video.mp4')
-        video_path = f"downloads/video_{user_id}_{uuid.uuid4().hex[:8]}_{file_name}"
-        
-        await status_msg.edit_text("📥 Downloading video...")
-        await file.download_to_drive(video_path)
+        while (remaining := batch.last_added + ALBUM_COLLECT_SECONDS - time.monotonic()) > 0:
+            await asyncio.sleep(remaining)
+        del pending_albums[group_id]
         
-        await status_msg.edit_text("🎬 Changing thumbnail...")
-        thumb_path = user_states[user_id]['thumbnail']
-        output_path = await process_video_with_thumbnail(video_path, thumb_path)
-        
-        gdrive_link = None
-        if gdrive:
-            try:
-                await status_msg.edit_text("☁️ Uploading to Google Drive...")
-                gdrive_link = await gdrive.upload_file(output_path, f"processed_{file_name}")
-            except Exception as e:
-                print(f"GDrive upload error: {e}")
-        
-        await status_msg.edit_text("📤 Uploading processed video...")
-        
-        caption_text = "✅ Video with new thumbnail!"
-        if gdrive_link:
-            caption_text += f"\n\n☁️ [Download from Google Drive]({gdrive_link})"
-        
-        with open(output_path, 'rb') as video_file:
-            await update.message.reply_video(
-                video=video_file,
-                caption=caption_text,
-                supports_streaming=True,
-                parse_mode='Markdown'
+        try:
+            # resized once for the whole album, pinned until it is sent
+            batch.prepared_thumb = await asyncio.get_running_loop().run_in_executor(
+                None, thumbnail_cache.acquire, batch.thumbnail
             )
+        except Exception as e:
+            await batch.status_msg.edit_text(f"❌ Error preparing thumbnail: {str(e)}")
+            return
         
-        await status_msg.delete()
-        
-        db.increment_videos_processed(user_id)
-        
-        if video_path and os.path.exists(video_path):
-            os.remove(video_path)
-        if output_path and os.path.exists(output_path):
-            os.remove(output_path)
+        handed_over = True
+        await queue_album_jobs(batch)
+    except Exception as e:
+        logger.error(f"Album {batch.batch_id} could not be queued: {describe_error(e)}")
+    finally:
+        pending_albums.pop(group_id, None)
+        if not handed_over:
+            await release_album(batch)
+
+async def stop_albums():
+    """Cancel the albums still being collected, on shutdown"""
+    collectors = list(album_collectors)
+    for collector in collectors:
+        collector.cancel()
+    await asyncio.gather(*collectors, return_exceptions=True)
+
+async def queue_album_jobs(batch):
+    for item in batch.items:
+        cached = result_cache.get(item.result_key)
+        if cached:
+            item.file_id = cached['file_id']
+            item.status = '✅ Ready'
+            continue
+        job = VideoJob(batch.user_id, item.update, batch.context, None, item.video, batch.thumbnail)
+        job.result_key = item.result_key
+        batch.add_job(item, job)
+        temp_files.track(batch.thumbnail, job.job_id)
+        video_queue.put(job)
+    
+    if batch.is_complete:
+        await send_album(batch)
+        return
+    await batch.refresh_status(force=True)
+    video_queue.request_refresh()
+
+async def download_video(job):
+    video = job.video
+    
+    # its scratch space was reserved by admit_video(), unless it could never fit
+    scratch_space.check(scratch_space.estimate(job.file_size))
+    
+    file = await job.context.bot.get_file(video.file_id)
+    
+    job.file_name = getattr(video, 'file_name', 'video.mp4')
+    
+    mime_type = getattr(video, 'mime_type', None)
+    is_remote = (file.file_path or '').startswith(('http://', 'https://'))
+    if STREAM_DOWNLOADS and is_remote and is_streamable(mime_type, job.file_name):
+        # downloaded by the process stage straight into ffmpeg
+        job.stream_file = file
+        return
+    
+    await download_to_disk(job, file)
+
+async def download_to_disk(job, file):
+    job.video_path = temp_files.track(
+        f"downloads/video_{job.user_id}_{uuid.uuid4().hex[:8]}_{job.file_name}", job.job_id
+    )
+    await job.status_msg.edit_text("📥 Downloading video...")
+    with STAGE_SECONDS.time(stage='download'):
+        await file.download_to_drive(job.video_path)
+
+async def change_thumbnail(job):
+    if job.stream_file:
+        await job.status_msg.edit_text("📥 Downloading and changing thumbnail...")
+        try:
+            job.output_path = await process_stream_with_thumbnail(job.stream_file.file_path, job.thumbnail)
+            temp_files.track(job.output_path, job.job_id)
+            return
+        except Exception as e:
+            # never str(e): aiohttp errors carry the file URL, which contains the bot token
+            logger.warning(f"Streaming failed ({describe_error(e)}), downloading first")
+            await download_to_disk(job, job.stream_file)
+    
+    await job.status_msg.edit_text("🎬 Changing thumbnail...")
+    job.output_path = await process_video_with_thumbnail(
+        job.video_path, job.thumbnail, consume_input=True, file_id=job.video.file_unique_id
+    )
+    temp_files.track(job.output_path, job.job_id)
+    temp_files.release(job.video_path, job.job_id)
+
+async def upload_video(job):
+    if job.batch:
+        await album_video_ready(job)
+        return
+    
+    status_msg = job.status_msg
+    
+    await status_msg.edit_text("📤 Uploading processed video...")
+    
+    caption_text = "✅ Video with new thumbnail!"
+    
+    with open(job.output_path, 'rb') as video_file, STAGE_SECONDS.time(stage='telegram_upload'):
+        sent = await job.update.message.reply_video(
+            video=video_file,
+            caption=caption_text,
+            supports_streaming=True,
+            parse_mode='Markdown'
+        )
+    
+    if drive_backup:
+        # the Drive link is added to the caption once the background upload is done
+        try:
+            drive_backup.enqueue(job.output_path, job.file_name, sent, caption_text)
+        except Exception as e:
+            logger.error(f"Could not queue Drive backup: {describe_error(e)}")
+    
+    sent_file = sent.video or sent.document
+    if sent_file and job.result_key:
+        result_cache.put(job.result_key, sent_file.file_id, caption_text)
+    
+    await status_msg.delete()
+    
+    db.increment_videos_processed(job.user_id)
+    JOBS.inc(result='done')
+    BYTES_PROCESSED.inc(job.file_size or 0)
+    JOB_SECONDS.observe(time.monotonic() - job.enqueued_at)
+    temp_files.release_owner(job.job_id)
+    await scratch_space.release(job.job_id)
+
+async def video_job_failed(job, error):
+    JOBS.inc(result='failed')
+    temp_files.release_owner(job.job_id)
+    await scratch_space.release(job.job_id)
+    if job.batch:
+        item = job.batch.item_for(job)
+        item.error = user_error(error)
+        await album_item_finished(job.batch, item, '❌ Failed')
+        return
+    await job.status_msg.edit_text(f"❌ Error processing video: {user_error(error)}")
+
+async def album_video_ready(job):
+    # the output waits for the rest of the album, the rest of its disk reservation does not:
+    # a large album could otherwise wait for space held by its own videos
+    await scratch_space.release(job.job_id)
+    scratch_space.claim(job.job_id, os.path.getsize(job.output_path))
+    await album_item_finished(job.batch, job.batch.item_for(job), '✅ Ready')
+
+async def album_item_finished(batch, item, status):
+    item.status = status
+    if batch.is_complete and not batch.sent:
+        await send_album(batch)
+    else:
+        await batch.refresh_status()
+
+async def send_album(batch):
+    """Send the finished videos of an album back as one album"""
+    batch.sent = True
+    ready = [item for item in batch.items if item.file_id or (item.job and not item.error)]
+    failed = [item for item in batch.items if item.error]
+    caption_text = "✅ Videos with new thumbnail!"
+    
+    try:
+        if ready:
+            await batch.status_msg.edit_text("📤 Uploading processed videos...")
+            with ExitStack() as files, STAGE_SECONDS.time(stage='telegram_upload'):
+                sources = [item.file_id or files.enter_context(open(item.job.output_path, 'rb')) for item in ready]
+                if len(sources) == 1:
+                    sent = [await batch.update.message.reply_video(
+                        video=sources[0],
+                        caption=caption_text,
+                        supports_streaming=True,
+                        parse_mode='Markdown'
+                    )]
+                else:
+                    sent = await batch.update.message.reply_media_group(media=[
+                        InputMediaVideo(
+                            source,
+                            caption=caption_text if index == 0 else None,
+                            parse_mode='Markdown',
+                            supports_streaming=True
+                        )
+                        for index, source in enumerate(sources)
+                    ])
+            
+            for index, (item, message) in enumerate(zip(ready, sent)):
+                if not item.job:
+                    JOBS.inc(result='cached')
+                    continue
+                caption = caption_text if index == 0 else ''
+                if drive_backup:
+                    try:
+                        drive_backup.enqueue(item.job.output_path, item.job.file_name, message, caption)
+                    except Exception as e:
+                        logger.error(f"Could not queue Drive backup: {describe_error(e)}")
+                sent_file = message.video or message.document
+                if sent_file:
+                    result_cache.put(item.result_key, sent_file.file_id, caption_text)
+                JOBS.inc(result='done')
+                BYTES_PROCESSED.inc(item.job.file_size or 0)
+                JOB_SECONDS.observe(time.monotonic() - item.job.enqueued_at)
+            # one counter update for the whole album
+            db.increment_videos_processed(batch.user_id, len(ready))
         
+        if failed:
+            await batch.status_msg.edit_text(
+                f"❌ {len(failed)} of {len(batch.items)} videos failed: {failed[0].error}"
+            )
+        else:
+            await batch.status_msg.delete()
     except Exception as e:
-        await status_msg.edit_text(f"❌ Error processing video: {str(e)}")
-        if video_path and os.path.exists(video_path):
-            os.remove(video_path)
-        if output_path and os.path.exists(output_path):
-            os.remove(output_path)
+        logger.error(f"Album {batch.batch_id} upload failed: {describe_error(e)}")
+        await batch.status_msg.edit_text("❌ Error uploading album, please try again")
+    finally:
+        await release_album(batch)
+
+async def release_album(batch):
+    for job in batch.jobs:
+        temp_files.release_owner(job.job_id)
+        await scratch_space.release(job.job_id)
+    temp_files.release_owner(batch.batch_id)
+    if batch.prepared_thumb:
+        thumbnail_cache.release(batch.prepared_thumb)
+        batch.prepared_thumb = None
+
+def expire_user_states(max_idle):
+    """Forget thumbnails not used for max_idle seconds, queued jobs keep their own copy"""
+    cutoff = time.monotonic() - max_idle
+    expired = [user_id for user_id, state in user_states.items() if state['last_used'] < cutoff]
+    for user_id in expired:
+        temp_files.release_owner(user_owner(user_id))
+        del user_states[user_id]
+    return len(expired)
+
+def describe_error(error):
+    status = getattr(error, 'status', None) or getattr(error, 'returncode', None)
+    return f"{type(error).__name__} {status}" if status is not None else type(error).__name__
+
+def admit_video(job):
+    """Reserve a job's scratch space before it takes a download slot, False keeps it queued"""
+    needed = scratch_space.estimate(job.file_size)
+    # one that could never fit is let through to be rejected by download_video()
+    return needed > scratch_space.budget or scratch_space.try_reserve(job.job_id, needed)
+
+def user_error(error):
+    """What the user is told about a failed job, never str(e) of errors that can carry the bot token"""
+    if isinstance(error, ScratchSpaceError):
+        return str(error)
+    return "something went wrong, please try again"
+
+def user_owner(user_id):
+    return f"user:{user_id}"
+
+video_queue = VideoJobQueue(
+    [
+        Stage('download', download_video, DOWNLOAD_WORKERS),
+        Stage('process', change_thumbnail, MAX_CONCURRENT_JOBS),
+        Stage('upload', upload_video, UPLOAD_WORKERS),
+    ],
+    on_error=video_job_failed,
+    buffer_size=PIPELINE_BUFFER_SIZE,
+    admit=admit_video
+)
+scratch_space.release_callbacks.append(video_queue.retry_admission)
 
 def generate_auth_key(length=12):
     chars = string.ascii_uppercase + string.digits
@@ -0,0 +1,347 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import uuid
+from collections import deque, Counter
+
+logger = logging.getLogger(__name__)
+
+# Throughput assumed before the first job finishes (bytes per second)
+DEFAULT_THROUGHPUT = 5 * 1024 * 1024
+# Minimum seconds between two queue position edits of the same status message
+STATUS_EDIT_INTERVAL = 5
+# Queue changes within this many seconds are shown with a single refresh
+POSITION_REFRESH_DELAY = 1
+# How the videos of an album are summed up, in pipeline order
+ALBUM_STATES = {
+    '✅': 'ready',
+    '📤': 'uploading',
+    '🎬': 'changing thumbnail',
+    '📥': 'downloading',
+    '💾': 'waiting for disk space',
+    '🕒': 'queued',
+    '❌': 'failed',
+}
+
+class VideoJob:
+    def __init__(self, user_id, update, context, status_msg, video, thumbnail):
+        self.job_id = uuid.uuid4().hex[:8]
+        self.user_id = user_id
+        self.update = update
+        self.context = context
+        self.status_msg = status_msg
+        self.video = video
+        self.thumbnail = thumbnail
+        self.file_size = getattr(video, 'file_size', None) or 0
+        self.enqueued_at = time.monotonic()
+        self.last_queue_status = None
+        self.waiting_for_space = False
+        self.last_status_edit = 0.0
+        self.file_name = None
+        self.video_path = None
+        self.output_path = None
+        self.result_key = None
+        self.stream_file = None
+        self.batch = None
+
+class AlbumItem:
+    __slots__ = ('update', 'video', 'result_key', 'job', 'file_id', 'status', 'error')
+    
+    def __init__(self, update, video, result_key):
+        self.update = update
+        self.video = video
+        self.result_key = result_key
+        self.job = None
+        self.file_id = None
+        self.status = '🕒 Queued'
+        self.error = None
+    
+    @property
+    def finished(self):
+        return self.status.startswith(('✅', '❌'))
+
+class AlbumStatus:
+    """Stands in for a job's status message, the album shows one summary instead"""
+    
+    def __init__(self, batch, item):
+        self.batch = batch
+        self.item = item
+    
+    async def edit_text(self, text, **kwargs):
+        self.item.status = text
+        await self.batch.refresh_status()
+    
+    async def delete(self):
+        pass
+
+class VideoBatch:
+    """The videos of one album (media group), sent back together as one album.
+
+    Each video still runs through the pipeline as its own VideoJob, so an
+    album is processed in parallel under the usual worker limits.
+    """
+    
+    def __init__(self, user_id, update, context, thumbnail):
+        self.batch_id = uuid.uuid4().hex[:8]
+        self.user_id = user_id
+        self.update = update
+        self.context = context
+        self.thumbnail = thumbnail
+        self.prepared_thumb = None
+        self.status_msg = None
+        self.sent = False
+        self.items = []
+        self.last_added = time.monotonic()
+        self.last_status_edit = 0.0
+        self.last_status_text = None
+    
+    def add(self, item):
+        self.items.append(item)
+        self.last_added = time.monotonic()
+    
+    def add_job(self, item, job):
+        item.job = job
+        job.batch = self
+        job.status_msg = AlbumStatus(self, item)
+    
+    def item_for(self, job):
+        return next(item for item in self.items if item.job is job)
+    
+    @property
+    def jobs(self):
+        return [item.job for item in self.items if item.job]
+    
+    @property
+    def is_complete(self):
+        return all(item.finished for item in self.items)
+    
+    def status_text(self):
+        counts = Counter(item.status[:1] for item in self.items)
+        states = [f"{emoji} {counts[emoji]} {label}" for emoji, label in ALBUM_STATES.items() if counts[emoji]]
+        return f"🎞️ Album of {len(self.items)} videos\n" + '\n'.join(states)
+    
+    async def refresh_status(self, force=False):
+        text = self.status_text()
+        now = time.monotonic()
+        if text == self.last_status_text:
+            return
+        if not force and now - self.last_status_edit < STATUS_EDIT_INTERVAL:
+            return
+        self.last_status_text = text
+        self.last_status_edit = now
+        try:
+            await self.status_msg.edit_text(text)
+        except Exception as e:
+            logger.debug(f"Album status edit failed: {e}")
+
+class Stage:
+    def __init__(self, name, handler, workers):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+
+class VideoJobQueue:
+    """Job queue for video processing with per-user fairness.
+
+    Users are served round-robin so one user forwarding many videos cannot
+    starve everybody else. Within a user's own backlog the smallest video
+    goes first, so short jobs are not stuck behind long ones.
+
+    Jobs then run through a pipeline of stages (download, process, upload),
+    each with its own workers and a bounded queue in front of it, so the
+    network and the CPU are busy with different videos at the same time.
+    A full queue makes the previous stage wait instead of piling up files.
+    
+    A job only enters the first stage once admit(job) returns True (e.g. its
+    disk space is reserved). Until then it stays queued and the next user's
+    job gets its turn; call retry_admission() when admit may say yes again.
+    """
+    
+    def __init__(self, stages, on_error, buffer_size=1, admit=None):
+        self.stages = stages
+        self.on_error = on_error
+        self.buffer_size = buffer_size
+        self.admit = admit or (lambda job: True)
+        self.workers = []
+        self._stage_queues = []
+        self._user_jobs = {}
+        self._users = deque()
+        self._counter = itertools.count()
+        self._changed = asyncio.Event()
+        self._running = set()
+        self._throughput = DEFAULT_THROUGHPUT
+        self._last_completion = None
+        self._positions_changed = asyncio.Event()
+        self._refresher = None
+    
+    async def start(self):
+        self._stage_queues = [None] + [
+            asyncio.Queue(maxsize=self.buffer_size) for _ in self.stages[1:]
+        ]
+        for index, stage in enumerate(self.stages):
+            for worker_index in range(stage.workers):
+                self.workers.append(asyncio.create_task(self._worker(index, worker_index)))
+        self._refresher = asyncio.create_task(self._refresh_loop())
+        layout = ', '.join(f"{stage.name}={stage.workers}" for stage in self.stages)
+        logger.info(f"🎞️ Video pipeline started ({layout})")
+    
+    async def stop(self):
+        tasks = self.workers + ([self._refresher] if self._refresher else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.workers = []
+        self._refresher = None
+    
+    def __len__(self):
+        return sum(len(jobs) for jobs in self._user_jobs.values())
+    
+    @property
+    def active_jobs(self):
+        return len(self._running)
+    
+    def put(self, job):
+        if job.user_id not in self._user_jobs:
+            self._user_jobs[job.user_id] = []
+            self._users.append(job.user_id)
+        heapq.heappush(self._user_jobs[job.user_id], (job.file_size, next(self._counter), job))
+        self._changed.set()
+    
+    def retry_admission(self):
+        self._changed.set()
+    
+    async def get(self):
+        while True:
+            job = self._pop_admitted()
+            if job is not None:
+                return job
+            self._changed.clear()
+            await self._changed.wait()
+    
+    def _pop_admitted(self):
+        """Next job in round-robin order, users whose smallest job is not admitted yet keep their turn"""
+        for index, user_id in enumerate(self._users):
+            jobs = self._user_jobs[user_id]
+            job = jobs[0][2]
+            if not self.admit(job):
+                if not job.waiting_for_space:
+                    job.waiting_for_space = True
+                    self.request_refresh()
+                continue
+            heapq.heappop(jobs)
+            del self._users[index]
+            if jobs:
+                self._users.append(user_id)
+            else:
+                del self._user_jobs[user_id]
+            return job
+        return None
+    
+    def pending_jobs(self):
+        """Waiting jobs in the order they will be started"""
+        queues = {user_id: sorted(self._user_jobs[user_id]) for user_id in self._users}
+        order = []
+        depth = 0
+        while True:
+            round_jobs = [queues[user_id][depth][2] for user_id in self._users if depth < len(queues[user_id])]
+            if not round_jobs:
+                return order
+            order.extend(round_jobs)
+            depth += 1
+    
+    def estimate_wait(self, bytes_ahead):
+        return bytes_ahead / self._throughput
+    
+    def enqueue(self, job):
+        self.put(job)
+        self.request_refresh()
+    
+    def request_refresh(self):
+        """Queue positions changed, the status messages are edited in the background"""
+        self._positions_changed.set()
+    
+    async def _refresh_loop(self):
+        # one task edits the status messages, so workers and handlers never
+        # wait for a round of Bot API calls; changes meanwhile are coalesced
+        while True:
+            await self._positions_changed.wait()
+            await asyncio.sleep(POSITION_REFRESH_DELAY)
+            self._positions_changed.clear()
+            try:
+                await self.refresh_positions()
+            except Exception as e:
+                logger.error(f"Queue position refresh failed: {e}")
+    
+    async def refresh_positions(self):
+        bytes_ahead = 0
+        now = time.monotonic()
+        for position, job in enumerate(self.pending_jobs(), start=1):
+            eta = self.estimate_wait(bytes_ahead + job.file_size)
+            bytes_ahead += job.file_size
+            status = (position, job.waiting_for_space)
+            if job.last_queue_status == status:
+                continue
+            if job.last_queue_status is not None and now - job.last_status_edit < STATUS_EDIT_INTERVAL:
+                continue
+            job.last_queue_status = status
+            job.last_status_edit = now
+            if job.waiting_for_space:
+                text = f"💾 Waiting for free disk space...\n🕒 Queued at position {position}"
+            else:
+                text = f"🕒 Queued at position {position}\n⏳ Estimated wait: {format_eta(eta)}"
+            try:
+                await job.status_msg.edit_text(text)
+            except Exception as e:
+                logger.debug(f"Queue status edit failed: {e}")
+    
+    def _record_completion(self, job):
+        now = time.monotonic()
+        interval = now - (self._last_completion or job.enqueued_at)
+        self._last_completion = now
+        if job.file_size and interval > 0:
+            rate = job.file_size / interval
+            self._throughput = 0.8 * self._throughput + 0.2 * rate
+    
+    async def _next_job(self, stage_index):
+        if stage_index == 0:
+            job = await self.get()
+            self._running.add(job)
+            self.request_refresh()
+            return job
+        return await self._stage_queues[stage_index].get()
+    
+    async def _worker(self, stage_index, worker_index):
+        stage = self.stages[stage_index]
+        is_last = stage_index == len(self.stages) - 1
+        while True:
+            job = await self._next_job(stage_index)
+            try:
+                await stage.handler(job)
+            except asyncio.CancelledError:
+                self._running.discard(job)
+                raise
+            except Exception as e:
+                logger.error(f"{stage.name} worker {worker_index} failed on job {job.job_id}: {e}")
+                self._running.discard(job)
+                try:
+                    await self.on_error(job, e)
+                except Exception as error:
+                    logger.error(f"Error handler failed on job {job.job_id}: {error}")
+                continue
+            
+            if is_last:
+                self._running.discard(job)
+                self._record_completion(job)
+            else:
+                await self._stage_queues[stage_index + 1].put(job)
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return "less than a minute"
+    minutes = seconds // 60
+    if minutes < 60:
+        return f"~{minutes} min"
+    return f"~{minutes // 60} h {minutes % 60} min"
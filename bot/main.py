@@ -1,14 +1,28 @@
 import os
+import shutil
+import signal
 import logging
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from bot.handlers import start, help_command, status, cancel, genkey_command
-from bot.handlers import handle_photo, handle_video, handle_text
+from bot.handlers import start, help_command, status, cancel, genkey_command, profile_command
+from bot.handlers import handle_photo, handle_video, handle_text, video_queue
+from bot import handlers
 from bot.database import Database
-from bot.gdrive import GDrive
-from bot.config import BOT_TOKEN, GDRIVE_ENABLED
+from bot.drive_backup import DriveBackupQueue
+from bot.scratch import scratch_space
+from bot.thumb_cache import thumbnail_cache
+from bot.result_cache import result_cache
+from bot.metrics import QUEUE_DEPTH, ACTIVE_JOBS, DRIVE_BACKUPS_PENDING
+from bot.metrics import DISK_FREE, CACHE_REQUESTS
+from bot.scheduler import Scheduler
+from bot.tempfiles import temp_files
+from bot.web import start_web_server, set_webhook
+from bot.update_processor import UserOrderedUpdateProcessor
+from bot.profiling import LoopMonitor, instrument_handlers
+from bot.config import BOT_TOKEN, BOT_API_URL, GDRIVE_ENABLED, STATS_FLUSH_INTERVAL, MAX_CONCURRENT_UPDATES
+from bot.config import USER_STATE_IDLE_HOURS, GOOGLE_CREDENTIALS
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -16,68 +30,122 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-db = Database()
-gdrive = GDrive() if GDRIVE_ENABLED else None
+async def log_alive():
+    """Periodic heartbeat, also evicts expired subscriptions from the cache"""
+    logger.info(f"✅ Bot alive - {datetime.now()}")
+    if handlers.drive_backup:
+        logger.info("☁️ Google Drive backups: Enabled")
+        logger.info(f"☁️ Drive backups pending: {len(handlers.drive_backup)}")
+    handlers.db.evict_expired()
+    usage = scratch_space.usage()
+    logger.info(
+        f"💾 Scratch space: {usage['reserved'] // 1048576}/{usage['budget'] // 1048576} MB "
+        f"reserved by {usage['jobs']} jobs, {usage['disk_free'] // 1048576} MB free on disk"
+    )
 
-async def keep_alive_task(application: Application):
-    """Background task to keep bot active and clean up files"""
-    counter = 0
-    while True:
-        try:
-            await asyncio.sleep(1)
-            counter += 1
-            
-            if counter % 600 == 0:
-                logger.info(f"✅ Bot alive - {datetime.now()}")
-                if gdrive:
-                    logger.info("☁️ Google Drive: Connected")
-            
-            if counter % 3600 == 0:
-                logger.info("🧹 Cleaning up old files...")
-                await cleanup_old_files()
-            
-        except Exception as e:
-            logger.error(f"Keep alive error: {e}")
+async def flush_stats():
+    handlers.db.flush()
 
 async def cleanup_old_files():
-    """Clean up temporary files older than 1 hour"""
-    try:
-        downloads_dir = "downloads"
-        outputs_dir = "outputs"
-        
-        for directory in [downloads_dir, outputs_dir]:
-            if os.path.exists(directory):
-                now = datetime.now()
-                for filename in os.listdir(directory):
-                    filepath = os.path.join(directory, filename)
-                    if os.path.isfile(filepath):
-                        file_modified = datetime.fromtimestamp(os.path.getmtime(filepath))
-                        if now - file_modified > timedelta(hours=1):
-                            os.remove(filepath)
-                            logger.info(f"Deleted old file: {filename}")
-    except Exception as e:
-        logger.error(f"Cleanup error: {e}")
+    """Delete temp files older than 1 hour that no job or user state owns"""
+    expired = handlers.expire_user_states(USER_STATE_IDLE_HOURS * 3600)
+    if expired:
+        logger.info(f"🧹 Forgot the thumbnails of {expired} idle users")
+    loop = asyncio.get_running_loop()
+    removed = await loop.run_in_executor(None, temp_files.sweep, 3600, temp_files.snapshot())
+    if removed:
+        logger.info(f"🧹 Deleted {removed} orphaned temp files")
+
+def create_drive_backup(db):
+    """The Drive backup queue if backups are enabled; the Drive client is built on its first upload"""
+    if not GDRIVE_ENABLED:
+        return None
+    if not GOOGLE_CREDENTIALS:
+        logger.warning("⚠️ GDRIVE_ENABLED is set but GOOGLE_CREDENTIALS_JSON is missing, Drive backups are off")
+        return None
+    return DriveBackupQueue(db)
+
+def register_metrics(drive_backup):
+    """Metrics read at scrape time from numbers the other modules already keep"""
+    QUEUE_DEPTH.set_function(lambda: len(video_queue))
+    ACTIVE_JOBS.set_function(lambda: video_queue.active_jobs)
+    DRIVE_BACKUPS_PENDING.set_function(lambda: len(drive_backup) if drive_backup else 0)
+    DISK_FREE.set_function(lambda: shutil.disk_usage(scratch_space.path).free)
+    CACHE_REQUESTS.set_function(lambda: {
+        ('result', 'hit'): result_cache.hits,
+        ('result', 'miss'): result_cache.misses,
+        ('thumbnail', 'hit'): thumbnail_cache.hits,
+        ('thumbnail', 'miss'): thumbnail_cache.misses,
+    })
 
 async def main():
     os.makedirs("downloads", exist_ok=True)
     os.makedirs("outputs", exist_ok=True)
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    db = Database()
+    drive_backup = create_drive_backup(db)
+    handlers.setup(db, drive_backup)
+    register_metrics(drive_backup)
+    
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(UserOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    )
+    if BOT_API_URL:
+        api_url = BOT_API_URL.rstrip('/')
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    application = builder.build()
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("status", status))
     application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(CommandHandler("genkey", genkey_command))
+    application.add_handler(CommandHandler("profile", profile_command))
     
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     application.add_handler(MessageHandler(filters.VIDEO | filters.Document.VIDEO, handle_video))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    instrument_handlers(application)
     
-    asyncio.create_task(keep_alive_task(application))
-    
-    logger.info("🤖 Bot started successfully!")
-    if gdrive:
-        logger.info("☁️ Google Drive backup enabled")
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
     
-    await application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        async with application:
+            await application.start()
+            loop_monitor = asyncio.create_task(LoopMonitor().run())
+            web_runner = await start_web_server(application)
+            if not await set_webhook(application):
+                await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                logger.info("🔄 Receiving updates via polling")
+            await video_queue.start()
+            if drive_backup:
+                await drive_backup.start(application.bot)
+            scheduler = Scheduler()
+            scheduler.every(600, log_alive)
+            scheduler.every(STATS_FLUSH_INTERVAL, flush_stats)
+            scheduler.every(3600, cleanup_old_files)
+            
+            logger.info("🤖 Bot started successfully!")
+            if drive_backup:
+                logger.info("☁️ Google Drive backup enabled")
+            
+            await stop_event.wait()
+            
+            logger.info("🛑 Shutting down...")
+            await scheduler.stop()
+            loop_monitor.cancel()
+            if application.updater.running:
+                await application.updater.stop()
+            await web_runner.cleanup()
+            await handlers.stop_albums()
+            await video_queue.stop()
+            if drive_backup:
+                await drive_backup.stop()
+            await application.stop()
+    finally:
+        db.close()
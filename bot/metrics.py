@@ -0,0 +1,145 @@
+"""
+Process metrics in the Prometheus text format, served at /metrics.
+
+Small on purpose: counters, gauges and histograms with optional labels,
+no client library. A metric can also read its value at scrape time from a
+function, for numbers other modules already keep (cache hits, queue size).
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+registry = []
+
+class Metric:
+    type = 'untyped'
+    
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = labels
+        self._values = {}
+        self._function = None
+        self._lock = threading.Lock()
+        registry.append(self)
+    
+    def set_function(self, function):
+        """Read the value at scrape time: a number, or {label values tuple: number}"""
+        self._function = function
+    
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+    
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+    
+    def value(self, **labels):
+        if self._function:
+            values = self._function()
+            return values if not self.label_names else values.get(self._key(labels), 0)
+        return self._values.get(self._key(labels), 0)
+    
+    def samples(self):
+        if self._function:
+            values = self._function()
+            if not self.label_names:
+                values = {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [(self.name + self._labels(key), value) for key, value in sorted(values.items())]
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name} {value}" for name, value in self.samples()]
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+    
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    type = 'histogram'
+    
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+    
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        samples = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket{self._labels(key, [('le', bound)])}", cumulative))
+            samples.append((f"{self.name}_bucket{self._labels(key, [('le', '+Inf')])}", count))
+            samples.append((f"{self.name}_sum{self._labels(key)}", round(total, 6)))
+            samples.append((f"{self.name}_count{self._labels(key)}", count))
+        return samples
+
+def render_metrics():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+STAGE_SECONDS = Histogram(
+    'yothumb_stage_seconds',
+    'Time spent in each step of a video job',
+    ('stage',)
+)
+JOB_SECONDS = Histogram('yothumb_job_seconds', 'Time from queueing a video to sending it back')
+JOBS = Counter('yothumb_jobs_total', 'Finished video jobs', ('result',))
+BYTES_PROCESSED = Counter('yothumb_bytes_processed_total', 'Size of the input videos processed')
+STRATEGIES = Counter('yothumb_thumbnail_strategy_total', 'Videos by thumbnail strategy', ('strategy',))
+REENCODE_FALLBACKS = Counter(
+    'yothumb_ffmpeg_reencode_fallbacks_total',
+    'Stream copies that failed and were re-encoded',
+    ('strategy',)
+)
+DB_WRITE_SECONDS = Histogram('yothumb_db_write_seconds', 'SQLite write transaction latency', buckets=DB_BUCKETS)
+CACHE_REQUESTS = Counter('yothumb_cache_requests_total', 'Cache lookups', ('cache', 'result'))
+QUEUE_DEPTH = Gauge('yothumb_queue_depth', 'Videos waiting to enter the pipeline')
+ACTIVE_JOBS = Gauge('yothumb_active_jobs', 'Videos in the pipeline')
+DRIVE_BACKUPS_PENDING = Gauge('yothumb_drive_backups_pending', 'Videos waiting for their Drive backup')
+LOOP_LAG = Gauge('yothumb_event_loop_lag_seconds', 'How late the event loop runs scheduled callbacks')
+LOOP_STALLS = Counter('yothumb_event_loop_stalls_total', 'Times a callback blocked the event loop past the threshold')
+HANDLER_SECONDS = Histogram('yothumb_handler_seconds', 'Time spent in each update handler', ('handler',))
+DISK_FREE = Gauge('yothumb_disk_free_bytes', 'Free space on the scratch disk')
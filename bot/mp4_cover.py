@@ -0,0 +1,232 @@
+"""
+Set MP4/MOV cover art by rewriting moov/udta/meta/ilst/covr directly.
+
+Only the moov box is rebuilt; the media data is never re-muxed. When moov
+is the last box (or a following free box can absorb the size change) the
+file is patched in place, otherwise it is copied with copy_file_range and
+the stco/co64 chunk offsets are shifted by the size difference.
+"""
+import os
+import struct
+
+# data atom type indicators
+TYPE_JPEG = 13
+TYPE_PNG = 14
+
+# boxes on the path from moov to stco/co64
+CONTAINERS = {b'trak', b'mdia', b'minf', b'stbl'}
+
+class UnsupportedMP4(Exception):
+    pass
+
+def box(box_type, payload):
+    return struct.pack('>I', 8 + len(payload)) + box_type + payload
+
+def parse_boxes(data, start=0, end=None):
+    """Yield (type, offset, size, header_size) for the boxes in data[start:end]"""
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise UnsupportedMP4(f"corrupt {box_type!r} box at {offset}")
+        yield box_type, offset, size, header
+        offset += size
+
+def read_top_level(f, file_size):
+    boxes = []
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        header = f.read(16)
+        size, box_type = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - offset
+        if size < header_size or offset + size > file_size:
+            raise UnsupportedMP4(f"corrupt top-level {box_type!r} box at {offset}")
+        boxes.append((box_type, offset, size, header_size))
+        offset += size
+    return boxes
+
+def meta_children_start(data, offset, header):
+    """meta is a full box in MP4 but a plain container in old QuickTime files"""
+    if data[offset + header + 4:offset + header + 8] == b'hdlr':
+        return offset + header
+    return offset + header + 4
+
+def build_ilst(ilst_payload, image, image_type):
+    children = b''.join(
+        bytes(ilst_payload[offset:offset + size])
+        for box_type, offset, size, _ in parse_boxes(ilst_payload)
+        if box_type != b'covr'
+    )
+    data_atom = box(b'data', struct.pack('>II', image_type, 0) + image)
+    return box(b'ilst', children + box(b'covr', data_atom))
+
+def build_meta(meta, image, image_type):
+    if meta is None:
+        hdlr = box(b'hdlr', struct.pack('>II4s4sII', 0, 0, b'mdir', b'appl', 0, 0) + b'\0')
+        return box(b'meta', b'\0\0\0\0' + hdlr + build_ilst(b'', image, image_type))
+
+    start = meta_children_start(meta, 0, 8)
+    children = []
+    ilst_found = False
+    for box_type, offset, size, header in parse_boxes(meta, start):
+        if box_type == b'ilst':
+            children.append(build_ilst(meta[offset + header:offset + size], image, image_type))
+            ilst_found = True
+        else:
+            children.append(bytes(meta[offset:offset + size]))
+    if not ilst_found:
+        children.append(build_ilst(b'', image, image_type))
+    return box(b'meta', bytes(meta[8:start]) + b''.join(children))
+
+def build_udta(udta, image, image_type):
+    if udta is None:
+        return box(b'udta', build_meta(None, image, image_type))
+
+    children = []
+    meta_found = False
+    for box_type, offset, size, header in parse_boxes(udta, 8):
+        if box_type == b'meta' and not meta_found:
+            meta = udta[offset:offset + size]
+            if header != 8:
+                meta = box(b'meta', bytes(meta[header:]))
+            children.append(build_meta(meta, image, image_type))
+            meta_found = True
+        else:
+            children.append(bytes(udta[offset:offset + size]))
+    if not meta_found:
+        children.append(build_meta(None, image, image_type))
+    return box(b'udta', b''.join(children))
+
+def build_moov(moov, image, image_type):
+    children = []
+    udta_found = False
+    for box_type, offset, size, header in parse_boxes(moov, 8):
+        if box_type == b'mvex':
+            raise UnsupportedMP4("fragmented MP4")
+        if box_type == b'udta' and not udta_found:
+            udta = moov[offset:offset + size]
+            if header != 8:
+                udta = box(b'udta', bytes(udta[header:]))
+            children.append(build_udta(udta, image, image_type))
+            udta_found = True
+        else:
+            children.append(bytes(moov[offset:offset + size]))
+    if not udta_found:
+        children.append(build_udta(None, image, image_type))
+    return bytearray(box(b'moov', b''.join(children)))
+
+def shift_chunk_offsets(moov, delta, after):
+    """Add delta to every stco/co64 entry pointing at or beyond `after`"""
+    def walk(start, end):
+        for box_type, offset, size, header in parse_boxes(moov, start, end):
+            if box_type in CONTAINERS:
+                walk(offset + header, offset + size)
+            elif box_type == b'stco':
+                count = struct.unpack_from('>I', moov, offset + header + 4)[0]
+                position = offset + header + 8
+                for _ in range(count):
+                    value = struct.unpack_from('>I', moov, position)[0]
+                    if value >= after:
+                        value += delta
+                        if value > 0xFFFFFFFF:
+                            raise UnsupportedMP4("chunk offset overflows stco")
+                        struct.pack_into('>I', moov, position, value)
+                    position += 4
+            elif box_type == b'co64':
+                count = struct.unpack_from('>I', moov, offset + header + 4)[0]
+                position = offset + header + 8
+                for _ in range(count):
+                    value = struct.unpack_from('>Q', moov, position)[0]
+                    if value >= after:
+                        struct.pack_into('>Q', moov, position, value + delta)
+                    position += 8
+    walk(8, len(moov))
+
+def copy_range(src, dst, offset, count):
+    """Copy count bytes from src at offset to the current position of dst, in the kernel"""
+    while count > 0:
+        try:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), count, offset)
+        except (AttributeError, OSError):
+            copied = os.sendfile(dst.fileno(), src.fileno(), offset, count)
+        if copied == 0:
+            raise OSError("unexpected end of file while copying")
+        offset += copied
+        count -= copied
+
+def set_cover(video_path, image_path, output_path, in_place=False):
+    """Write image_path as the cover art of video_path into output_path.
+
+    With in_place=True the input file may be patched and moved to
+    output_path instead of copied. Raises UnsupportedMP4 when the file
+    layout is not handled, before anything has been written.
+    """
+    with open(image_path, 'rb') as f:
+        image = f.read()
+    image_type = TYPE_PNG if image.startswith(b'\x89PNG') else TYPE_JPEG
+
+    file_size = os.path.getsize(video_path)
+    with open(video_path, 'rb', buffering=0) as src:
+        boxes = read_top_level(src, file_size)
+        types = [box_type for box_type, _, _, _ in boxes]
+        if types.count(b'moov') != 1 or b'mdat' not in types or b'moof' in types:
+            raise UnsupportedMP4("expected a single moov and no fragments")
+
+        index = types.index(b'moov')
+        _, moov_offset, moov_size, moov_header = boxes[index]
+        src.seek(moov_offset)
+        moov = bytearray(src.read(moov_size))
+        if moov_header != 8:
+            moov = bytearray(box(b'moov', bytes(moov[moov_header:])))
+
+        new_moov = build_moov(moov, image, image_type)
+        delta = len(new_moov) - moov_size
+        moov_end = moov_offset + moov_size
+        following = boxes[index + 1] if index + 1 < len(boxes) else None
+
+        if following is None:
+            patch = bytes(new_moov)
+            truncate_at = moov_offset + len(patch)
+        elif following[0] == b'free' and following[2] - delta >= 8 and following[2] - delta < 2 ** 32:
+            padding = following[2] - delta
+            patch = bytes(new_moov) + struct.pack('>I4s', padding, b'free')
+            truncate_at = None
+        else:
+            shift_chunk_offsets(new_moov, delta, moov_end)
+            patch = None
+
+        if patch is not None and in_place:
+            with open(video_path, 'r+b') as dst:
+                dst.seek(moov_offset)
+                dst.write(patch)
+                if truncate_at is not None:
+                    dst.truncate(truncate_at)
+            os.replace(video_path, output_path)
+            return output_path
+
+        with open(output_path, 'wb', buffering=0) as dst:
+            copy_range(src, dst, 0, moov_offset)
+            if patch is not None:
+                # the rest of the absorbing free box and the boxes after it keep their offsets
+                dst.write(patch)
+                rest = moov_offset + len(patch)
+                end = truncate_at if truncate_at is not None else file_size
+            else:
+                dst.write(bytes(new_moov))
+                rest = moov_end
+                end = file_size
+            copy_range(src, dst, rest, end - rest)
+    return output_path
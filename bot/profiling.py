@@ -0,0 +1,117 @@
+"""
+Finding what blocks the event loop in production.
+
+LoopMonitor ticks inside the loop and records the lag; a watchdog thread
+logs the loop thread's stack whenever a tick is overdue, which points at
+the blocking call directly. timed() wraps handler callbacks, and
+sample_stacks() is the sampling profiler behind the /profile command.
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import functools
+import threading
+import traceback
+from collections import Counter
+from bot.config import LOOP_STALL_THRESHOLD, SLOW_HANDLER_THRESHOLD
+from bot.metrics import LOOP_LAG, LOOP_STALLS, HANDLER_SECONDS
+
+logger = logging.getLogger(__name__)
+
+class LoopMonitor:
+    def __init__(self, interval=0.25, threshold=LOOP_STALL_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = 0
+        self.last_tick = time.monotonic()
+        self.loop_thread = None
+        self._stopped = threading.Event()
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self._stopped.clear()
+        watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        watchdog.start()
+        try:
+            while True:
+                started = loop.time()
+                self.last_tick = time.monotonic()
+                await asyncio.sleep(self.interval)
+                LOOP_LAG.set(max(loop.time() - started - self.interval, 0))
+        finally:
+            self._stopped.set()
+    
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.threshold / 4):
+            tick = self.last_tick
+            blocked = time.monotonic() - tick - self.interval
+            if blocked < self.threshold or tick == reported:
+                continue
+            # one report per stall, taken while the blocking call is still running
+            reported = tick
+            self.stalls += 1
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = ''.join(traceback.format_stack(frame)) if frame else 'unavailable\n'
+            logger.warning(f"🐢 Event loop blocked for {blocked:.2f}s so far, stack:\n{stack}")
+
+def timed(callback):
+    """Record how long a handler callback takes and log the slow ones"""
+    name = getattr(callback, '__name__', repr(callback))
+    
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.monotonic()
+        try:
+            return await callback(update, context)
+        finally:
+            elapsed = time.monotonic() - started
+            HANDLER_SECONDS.observe(elapsed, handler=name)
+            if elapsed >= SLOW_HANDLER_THRESHOLD:
+                logger.warning(f"🐢 Handler {name} took {elapsed:.2f}s")
+    return wrapper
+
+def instrument_handlers(application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = timed(handler.callback)
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_stacks(thread_id, duration, interval=0.005):
+    """Sample the stack of thread_id for duration seconds, blocking (run it in another thread).
+
+    Returns a Counter of collapsed stacks ("outer;...;inner" -> samples),
+    the input format of flamegraph.pl and speedscope.
+    """
+    stacks = Counter()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            names.append(frame_name(frame))
+            frame = frame.f_back
+        if names:
+            stacks[';'.join(reversed(names))] += 1
+        time.sleep(interval)
+    return stacks
+
+def summarize_stacks(stacks, top=10):
+    """Functions that were running (self time) in the most samples"""
+    total = sum(stacks.values())
+    if not total:
+        return "No samples"
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    lines = [f"{total} samples"]
+    for name, count in leaves.most_common(top):
+        lines.append(f"{100 * count / total:5.1f}%  {name}")
+    return '\n'.join(lines)
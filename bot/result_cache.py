@@ -0,0 +1,40 @@
+import time
+from collections import OrderedDict
+from bot.config import RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+
+class ResultCache:
+    """LRU + TTL cache of already processed videos.
+
+    Keys are (video file_unique_id, thumbnail hash) and values are the
+    Telegram file_id and caption of the video we sent back, so the same
+    request can be answered by re-sending the file_id.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, file_id, caption):
+        self._entries[key] = (time.monotonic() + self.ttl, {'file_id': file_id, 'caption': caption})
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+result_cache = ResultCache()
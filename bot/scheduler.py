@@ -0,0 +1,30 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Scheduler:
+    """Runs periodic coroutines, each sleeping until its own next run"""
+
+    def __init__(self):
+        self.tasks = {}
+
+    def every(self, interval, callback, name=None):
+        name = name or callback.__name__
+        self.tasks[name] = asyncio.create_task(self._run(interval, callback, name))
+
+    async def _run(self, interval, callback, name):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await callback()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Scheduled job {name} failed: {e}")
+
+    async def stop(self):
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks = {}
@@ -0,0 +1,90 @@
+import asyncio
+import shutil
+import logging
+from bot.config import SCRATCH_BUDGET_MB
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Share of the free disk used as budget when SCRATCH_BUDGET_MB is not set
+DEFAULT_BUDGET_SHARE = 0.8
+
+class ScratchSpaceError(Exception):
+    pass
+
+class ScratchSpace:
+    """Admission control for temporary files in downloads/, outputs/ and backups/.
+
+    Every job reserves its estimated disk usage before it starts. Jobs that
+    don't fit wait until enough space is released, and jobs that could
+    never fit are rejected immediately instead of failing halfway with
+    ENOSPC. Files kept after their job, like outputs waiting for a Drive
+    backup, are claimed until they are deleted. Callbacks in
+    release_callbacks are called whenever space is released.
+    """
+    
+    def __init__(self, budget_bytes=None, path='.'):
+        self.path = path
+        if not budget_bytes:
+            budget_bytes = int(shutil.disk_usage(path).free * DEFAULT_BUDGET_SHARE)
+        self.budget = budget_bytes
+        self.reserved = 0
+        self._reservations = {}
+        self._released = asyncio.Condition()
+        self.release_callbacks = []
+    
+    @staticmethod
+    def estimate(file_size):
+        """Input plus output copy of the video"""
+        return max(2 * (file_size or 0), MB)
+    
+    def check(self, nbytes):
+        """Reject what could never fit instead of waiting for it forever"""
+        if nbytes > self.budget:
+            raise ScratchSpaceError(
+                f"Video too large: needs {nbytes // MB} MB of scratch space, limit is {self.budget // MB} MB"
+            )
+    
+    async def reserve(self, owner, nbytes):
+        self.check(nbytes)
+        async with self._released:
+            await self._released.wait_for(lambda: self.reserved + nbytes <= self.budget)
+            self._reservations[owner] = self._reservations.get(owner, 0) + nbytes
+            self.reserved += nbytes
+    
+    def try_reserve(self, owner, nbytes):
+        """Reserve only if it fits right now, never waits"""
+        if not self.fits(nbytes):
+            return False
+        self.claim(owner, nbytes)
+        return True
+    
+    def claim(self, owner, nbytes):
+        """Account for bytes already on disk, never waits (the budget may be exceeded)"""
+        self._reservations[owner] = self._reservations.get(owner, 0) + nbytes
+        self.reserved += nbytes
+    
+    def fits(self, nbytes):
+        return self.reserved + nbytes <= self.budget
+    
+    async def release(self, owner):
+        nbytes = self._reservations.pop(owner, 0)
+        if not nbytes:
+            return
+        async with self._released:
+            self.reserved -= nbytes
+            self._released.notify_all()
+        for callback in self.release_callbacks:
+            callback()
+    
+    def usage(self):
+        disk = shutil.disk_usage(self.path)
+        return {
+            'budget': self.budget,
+            'reserved': self.reserved,
+            'jobs': len(self._reservations),
+            'disk_free': disk.free,
+            'disk_total': disk.total,
+        }
+
+scratch_space = ScratchSpace(SCRATCH_BUDGET_MB * MB)
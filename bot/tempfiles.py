@@ -0,0 +1,77 @@
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+TEMP_DIRECTORIES = ('downloads', 'outputs')
+
+class TempFileRegistry:
+    """Tracks which live job or user state owns each temporary file.
+
+    A file is deleted as soon as its last owner releases it, so a thumbnail
+    shared by a user's state and several queued jobs survives until all of
+    them are done. sweep() only removes files nobody owns.
+    """
+
+    def __init__(self, directories=TEMP_DIRECTORIES):
+        self.directories = directories
+        self._owners = {}
+        self._paths = {}
+
+    def __contains__(self, path):
+        return path in self._owners
+
+    def track(self, path, owner):
+        self._owners.setdefault(path, set()).add(owner)
+        self._paths.setdefault(owner, set()).add(path)
+        return path
+
+    def release(self, path, owner):
+        owners = self._owners.get(path)
+        if owners is None:
+            return
+        owners.discard(owner)
+        paths = self._paths.get(owner)
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del self._paths[owner]
+        if not owners:
+            del self._owners[path]
+            remove_file(path)
+
+    def release_owner(self, owner):
+        for path in list(self._paths.get(owner, ())):
+            self.release(path, owner)
+
+    def snapshot(self):
+        return frozenset(self._owners)
+
+    def sweep(self, max_age, tracked):
+        """Delete untracked files older than max_age seconds, blocking (run in an executor)"""
+        cutoff = time.time() - max_age
+        removed = 0
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    path = os.path.join(directory, entry.name)
+                    if path in tracked or not entry.is_file():
+                        continue
+                    if entry.stat().st_mtime < cutoff and remove_file(path):
+                        removed += 1
+        return removed
+
+def remove_file(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        logger.error(f"Could not delete {path}: {e}")
+        return False
+
+temp_files = TempFileRegistry()
@@ -0,0 +1,110 @@
+import os
+import hashlib
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from bot.config import THUMB_CACHE_DIR, THUMB_CACHE_MAX_MB
+
+logger = logging.getLogger(__name__)
+
+THUMB_SIZE = (1280, 720)
+
+def prepare_thumbnail(thumbnail_path, output_path, size=THUMB_SIZE):
+    # Pillow is imported on first use to keep it out of startup
+    from PIL import Image
+    
+    thumb = Image.open(thumbnail_path)
+    thumb = thumb.convert('RGB')
+    thumb.thumbnail(size, Image.Resampling.LANCZOS)
+    thumb.save(output_path, 'JPEG', quality=95, optimize=True)
+    return output_path
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ThumbnailCache:
+    """On-disk LRU of resized thumbnails, keyed by image content and size.
+
+    The same image sent for many videos (or by many users) is resized and
+    encoded only once. Entries in use are pinned so eviction can't remove a
+    file ffmpeg is about to read. Methods block and belong in an executor.
+    """
+    
+    def __init__(self, directory=THUMB_CACHE_DIR, max_bytes=THUMB_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+        self._total_bytes = 0
+        self._pinned = {}
+        self._lock = threading.Lock()
+    
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.jpg'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        self._entries = OrderedDict((path, size) for _, path, size in sorted(entries))
+        self._total_bytes = sum(self._entries.values())
+    
+    def acquire(self, source_path, size=THUMB_SIZE):
+        """Return the path of the prepared JPEG for source_path and pin it"""
+        key = f"{file_digest(source_path)}_{size[0]}x{size[1]}.jpg"
+        path = os.path.join(self.directory, key)
+        
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            if path in self._entries:
+                self._entries.move_to_end(path)
+                self._pinned[path] = self._pinned.get(path, 0) + 1
+                self.hits += 1
+                return path
+        
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            prepare_thumbnail(source_path, temp_path, size)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        
+        with self._lock:
+            if path not in self._entries:
+                self._entries[path] = os.path.getsize(path)
+                self._total_bytes += self._entries[path]
+            self._entries.move_to_end(path)
+            self._pinned[path] = self._pinned.get(path, 0) + 1
+            self.misses += 1
+            self._evict()
+        return path
+    
+    def release(self, path):
+        with self._lock:
+            count = self._pinned.get(path, 0) - 1
+            if count > 0:
+                self._pinned[path] = count
+            else:
+                self._pinned.pop(path, None)
+    
+    def _evict(self):
+        for path in list(self._entries):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if path in self._pinned:
+                continue
+            self._total_bytes -= self._entries.pop(path)
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Could not evict cached thumbnail {path}: {e}")
+
+thumbnail_cache = ThumbnailCache()
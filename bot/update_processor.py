@@ -0,0 +1,69 @@
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates waiting for their user's lane count against this, not against the slots
+MAX_PENDING_UPDATES = 256
+
+class Lane:
+    __slots__ = ('lock', 'waiting')
+    
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different users concurrently, each user's in order.
+
+    A thumbnail followed by videos is therefore always handled photo first.
+    Commands and plain text (auth keys) take the fast lane: they neither wait
+    for the user's lane nor for a free slot, so /cancel and /status answer
+    while a photo is still downloading.
+    """
+    
+    def __init__(self, max_concurrent_updates):
+        super().__init__(MAX_PENDING_UPDATES)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._lanes = {}
+    
+    @staticmethod
+    def is_fast_lane(update):
+        message = update.effective_message if isinstance(update, Update) else None
+        return message is not None and message.text is not None
+    
+    @staticmethod
+    def lane_key(update):
+        if isinstance(update, Update) and update.effective_user:
+            return update.effective_user.id
+        return None
+    
+    async def do_process_update(self, update, coroutine):
+        if self.is_fast_lane(update):
+            await coroutine
+            return
+        
+        key = self.lane_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = Lane()
+        lane.waiting += 1
+        try:
+            # asyncio.Lock wakes waiters first come, first served
+            async with lane.lock:
+                async with self._slots:
+                    await coroutine
+        finally:
+            lane.waiting -= 1
+            if not lane.waiting:
+                del self._lanes[key]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
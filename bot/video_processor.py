@@ -1,59 +1,353 @@
 import os
-import subprocess
+import json
+import time
+import asyncio
 import uuid
-from PIL import Image
+import logging
+from collections import OrderedDict
+import aiohttp
+from bot.config import MAX_CONCURRENT_JOBS
+from bot.thumb_cache import thumbnail_cache
+from bot.mp4_cover import set_cover, UnsupportedMP4
+from bot.metrics import STAGE_SECONDS, STRATEGIES, REENCODE_FALLBACKS
 
-async def process_video_with_thumbnail(video_path, thumbnail_path):
-    thumb = Image.open(thumbnail_path)
-    thumb = thumb.convert('RGB')
-    thumb.thumbnail((1280, 720), Image.Resampling.LANCZOS)
-    
-    temp_thumb = f"downloads/thumb_resized_{uuid.uuid4().hex[:8]}.jpg"
-    thumb.save(temp_thumb, 'JPEG', quality=95, optimize=True)
+logger = logging.getLogger(__name__)
+
+# Codecs that can be stream-copied into an MP4 container
+MP4_CODECS = {
+    'video': {'h264', 'hevc', 'mpeg4', 'av1', 'vp9', 'mjpeg'},
+    'audio': {'aac', 'mp3', 'ac3', 'eac3', 'opus', 'flac', 'alac'},
+}
+PROBE_CACHE_SIZE = 256
+# Containers ffmpeg can read front to back from a pipe (MP4/MOV may need to seek to moov)
+STREAMABLE_MIME_TYPES = {'video/x-matroska', 'video/webm', 'video/mp2t', 'video/x-flv'}
+STREAMABLE_EXTENSIONS = {'.mkv', '.webm', '.ts', '.flv'}
+STREAM_CHUNK_SIZE = 256 * 1024
+
+_job_semaphore = None
+_probe_cache = OrderedDict()
+
+def get_job_semaphore():
+    """Semaphore limiting how many videos are processed at the same time"""
+    global _job_semaphore
+    if _job_semaphore is None:
+        _job_semaphore = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+    return _job_semaphore
+
+class FFmpegError(Exception):
+    def __init__(self, returncode, stderr):
+        super().__init__(f"ffmpeg exited with code {returncode}")
+        self.returncode = returncode
+        self.stderr = stderr
+
+async def run_ffmpeg(cmd):
+    with STAGE_SECONDS.time(stage='ffmpeg'):
+        await _run_ffmpeg(cmd)
+
+async def _run_ffmpeg(cmd):
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
     
-    output_path = f"outputs/output_{uuid.uuid4().hex[:8]}.mp4"
+    if process.returncode != 0:
+        raise FFmpegError(process.returncode, stderr.decode(errors='replace'))
+
+async def probe_video(video_path, cache_key=None):
+    """ffprobe the file. Returns None if probing fails.
+
+    Every job downloads to a new path, so results are only cached under
+    cache_key, the Telegram file_unique_id of the video.
+    """
+    if cache_key in _probe_cache:
+        _probe_cache.move_to_end(cache_key)
+        return _probe_cache[cache_key]
     
     cmd = [
+        'ffprobe', '-v', 'error',
+        '-print_format', 'json',
+        '-show_format', '-show_streams',
+        video_path
+    ]
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+    except OSError as e:
+        logger.warning(f"ffprobe unavailable: {e}")
+        return None
+    if process.returncode != 0:
+        logger.warning(f"ffprobe failed: {stderr.decode(errors='replace')}")
+        return None
+    
+    probe = json.loads(stdout)
+    if cache_key is not None:
+        _probe_cache[cache_key] = probe
+        while len(_probe_cache) > PROBE_CACHE_SIZE:
+            _probe_cache.popitem(last=False)
+    return probe
+
+def is_attached_pic(stream):
+    return stream.get('disposition', {}).get('attached_pic') == 1
+
+def is_cover_attachment(stream):
+    filename = stream.get('tags', {}).get('filename', '').lower()
+    return stream.get('codec_type') == 'attachment' and filename.startswith('cover')
+
+def choose_strategy(probe):
+    """Pick the cheapest way to set the thumbnail for a probed file"""
+    format_names = probe.get('format', {}).get('format_name', '').split(',')
+    streams = [s for s in probe.get('streams', []) if not is_attached_pic(s)]
+    media = [s for s in streams if s.get('codec_type') in ('video', 'audio')]
+    mp4_compatible = all(
+        s.get('codec_name') in MP4_CODECS[s['codec_type']] for s in media
+    )
+    
+    if mp4_compatible and 'mp4' in format_names:
+        return 'mp4_cover'
+    if mp4_compatible:
+        return 'remux_mp4'
+    if 'matroska' in format_names:
+        return 'mkv_attachment'
+    return 'reencode'
+
+def build_command(strategy, probe, video_path, thumb_path, output_path):
+    streams = probe['streams'] if probe else []
+    cmd = ['ffmpeg', '-i', video_path, '-i', thumb_path]
+    
+    if strategy == 'mkv_attachment':
+        cmd += ['-map', '0']
+        kept_attachments = 0
+        for stream in streams:
+            if is_attached_pic(stream) or is_cover_attachment(stream):
+                cmd += ['-map', f"-0:{stream['index']}"]
+            elif stream.get('codec_type') == 'attachment':
+                kept_attachments += 1
+        # -attach streams come after every mapped one, so after the kept fonts
+        cmd += [
+            '-c', 'copy',
+            '-attach', thumb_path,
+            f'-metadata:s:t:{kept_attachments}', 'mimetype=image/jpeg',
+            f'-metadata:s:t:{kept_attachments}', 'filename=cover.jpg',
+        ]
+        return cmd + ['-y', output_path]
+    
+    video_count = 0
+    for stream in streams:
+        codec_type = stream.get('codec_type')
+        keep = (
+            codec_type == 'audio'
+            or (codec_type == 'video' and not is_attached_pic(stream))
+            or (codec_type == 'subtitle' and stream.get('codec_name') == 'mov_text')
+        )
+        if keep:
+            cmd += ['-map', f"0:{stream['index']}"]
+            if codec_type == 'video':
+                video_count += 1
+    cmd += ['-map', '1']
+    
+    if strategy == 'reencode':
+        cmd += ['-c', 'copy', '-c:v', 'libx264', '-preset', 'fast', '-crf', '18']
+        for position, stream in enumerate(s for s in streams if s.get('codec_type') == 'audio'):
+            if stream.get('codec_name') not in MP4_CODECS['audio']:
+                cmd += [f'-c:a:{position}', 'aac']
+    else:
+        cmd += ['-c', 'copy']
+    
+    cmd += [
+        f'-c:v:{video_count}', 'mjpeg',
+        f'-disposition:v:{video_count}', 'attached_pic',
+        '-y',
+        output_path
+    ]
+    return cmd
+
+def legacy_command(reencode, video_path, thumb_path, output_path):
+    """Commands used when ffprobe is not available"""
+    if not reencode:
+        return [
+            'ffmpeg',
+            '-i', video_path,
+            '-i', thumb_path,
+            '-map', '0',
+            '-map', '1',
+            '-c', 'copy',
+            '-c:v:1', 'mjpeg',
+            '-disposition:v:1', 'attached_pic',
+            '-y',
+            output_path
+        ]
+    return [
         'ffmpeg',
         '-i', video_path,
-        '-i', temp_thumb,
-        '-map', '0',
-        '-map', '1',
-        '-c', 'copy',
+        '-i', thumb_path,
+        '-map', '0:v', '-map', '0:a?', '-map', '1',
+        '-c:v', 'libx264',
+        '-preset', 'fast',
+        '-crf', '18',
+        '-c:a', 'copy',
         '-c:v:1', 'mjpeg',
         '-disposition:v:1', 'attached_pic',
         '-y',
         output_path
     ]
+
+async def process_video_with_thumbnail(video_path, thumbnail_path, consume_input=False, file_id=None):
+    """Return the path of a copy of video_path with the new thumbnail.
+
+    With consume_input=True the input may be patched and moved to the
+    output path instead of being copied, so callers must not reuse it.
+    file_id (the Telegram file_unique_id) lets the probe be reused when
+    the same video comes back with another thumbnail.
+    """
+    async with get_job_semaphore():
+        return await _process_video(video_path, thumbnail_path, consume_input, file_id)
+
+async def _process_video(video_path, thumbnail_path, consume_input, file_id):
+    loop = asyncio.get_running_loop()
+    with STAGE_SECONDS.time(stage='thumbnail'):
+        prepared_thumb = await loop.run_in_executor(None, thumbnail_cache.acquire, thumbnail_path)
+    output_path = None
     
     try:
-        result = subprocess.run(
-            cmd,
-            check=True,
-            capture_output=True,
-            text=True
-        )
-    except subprocess.CalledProcessError as e:
-        print(f"Stream copy failed, trying re-encode: {e.stderr}")
+        started = time.monotonic()
+        probe = await probe_video(video_path, file_id)
+        probe_time = time.monotonic() - started
+        STAGE_SECONDS.observe(probe_time, stage='probe')
+        
+        strategy = choose_strategy(probe) if probe else 'legacy'
+        extension = 'mkv' if strategy == 'mkv_attachment' else 'mp4'
+        output_path = f"outputs/output_{uuid.uuid4().hex[:8]}.{extension}"
+        
+        started = time.monotonic()
+        if strategy == 'mp4_cover':
+            try:
+                with STAGE_SECONDS.time(stage='mp4_cover'):
+                    await loop.run_in_executor(
+                        None, set_cover, video_path, prepared_thumb, output_path, consume_input
+                    )
+                strategy = 'mp4_atom'
+            except UnsupportedMP4 as e:
+                logger.info(f"Native cover writer skipped: {e}")
         
+        if strategy != 'mp4_atom':
+            try:
+                if probe:
+                    cmd = build_command(strategy, probe, video_path, prepared_thumb, output_path)
+                else:
+                    cmd = legacy_command(False, video_path, prepared_thumb, output_path)
+                await run_ffmpeg(cmd)
+            except FFmpegError as e:
+                if strategy == 'reencode':
+                    raise
+                logger.warning(f"{strategy} failed, falling back to re-encode: {e.stderr}")
+                REENCODE_FALLBACKS.inc(strategy=strategy)
+                strategy = f"{strategy}->reencode"
+                if extension != 'mp4':
+                    if os.path.exists(output_path):
+                        os.remove(output_path)
+                    output_path = f"outputs/output_{uuid.uuid4().hex[:8]}.mp4"
+                if probe:
+                    cmd = build_command('reencode', probe, video_path, prepared_thumb, output_path)
+                else:
+                    cmd = legacy_command(True, video_path, prepared_thumb, output_path)
+                await run_ffmpeg(cmd)
+        
+        STRATEGIES.inc(strategy=strategy)
+        logger.info(
+            f"🎬 {os.path.basename(video_path)}: {strategy} in {time.monotonic() - started:.2f}s "
+            f"(probe {probe_time:.2f}s)"
+        )
+    except BaseException:
+        if output_path and os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    finally:
+        thumbnail_cache.release(prepared_thumb)
+    
+    return output_path
+
+def is_streamable(mime_type, file_name):
+    extension = os.path.splitext(file_name or '')[1].lower()
+    return mime_type in STREAMABLE_MIME_TYPES or extension in STREAMABLE_EXTENSIONS
+
+async def process_stream_with_thumbnail(url, thumbnail_path):
+    """Pipe the download at url straight into ffmpeg, only the output touches disk.
+
+    The first video stream and all audio are copied into MP4. Raises
+    FFmpegError if that is not possible, callers then fall back to
+    downloading the file and process_video_with_thumbnail.
+    """
+    async with get_job_semaphore():
+        loop = asyncio.get_running_loop()
+        with STAGE_SECONDS.time(stage='thumbnail'):
+            prepared_thumb = await loop.run_in_executor(None, thumbnail_cache.acquire, thumbnail_path)
+        output_path = f"outputs/output_{uuid.uuid4().hex[:8]}.mp4"
         cmd = [
             'ffmpeg',
-            '-i', video_path,
-            '-i', temp_thumb,
-            '-map', '0:v', '-map', '0:a?', '-map', '1',
-            '-c:v', 'libx264',
-            '-preset', 'fast',
-            '-crf', '18',
-            '-c:a', 'copy',
+            '-i', 'pipe:0',
+            '-i', prepared_thumb,
+            '-map', '0:V:0', '-map', '0:a?', '-map', '1',
+            '-c', 'copy',
             '-c:v:1', 'mjpeg',
             '-disposition:v:1', 'attached_pic',
             '-y',
             output_path
         ]
-        
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
-    
-    if os.path.exists(temp_thumb):
-        os.remove(temp_thumb)
-    
-    return output_path
+        started = time.monotonic()
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            _, stderr = await asyncio.gather(
+                _feed_stdin(process, url),
+                process.stderr.read()
+            )
+            await process.wait()
+            if process.returncode != 0:
+                raise FFmpegError(process.returncode, stderr.decode(errors='replace'))
+            STAGE_SECONDS.observe(time.monotonic() - started, stage='stream')
+            STRATEGIES.inc(strategy='stream')
+            logger.info(f"🎬 streamed remux in {time.monotonic() - started:.2f}s")
+        except BaseException:
+            if process and process.returncode is None:
+                process.kill()
+                await process.wait()
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+        finally:
+            thumbnail_cache.release(prepared_thumb)
+        return output_path
+
+async def _feed_stdin(process, url):
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg gave up early, its exit code and stderr tell why
+        return
+    finally:
+        if not process.stdin.is_closing():
+            process.stdin.close()
@@ -0,0 +1,86 @@
+import shutil
+import logging
+from aiohttp import web
+from telegram import Update
+from telegram.error import TelegramError
+from bot.config import PORT, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, MAX_CONCURRENT_UPDATES
+from bot.config import HEALTH_MAX_LOOP_LAG, HEALTH_MIN_FREE_MB
+from bot.metrics import render_metrics, LOOP_LAG, QUEUE_DEPTH, ACTIVE_JOBS
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+def readiness():
+    loop_lag = LOOP_LAG.value()
+    disk_free = shutil.disk_usage('.').free
+    ready = loop_lag <= HEALTH_MAX_LOOP_LAG and disk_free >= HEALTH_MIN_FREE_MB * 1024 * 1024
+    return {
+        'status': 'ok' if ready else 'degraded',
+        'message': 'Bot is running',
+        'loop_lag_ms': round(loop_lag * 1000, 1),
+        'disk_free_mb': disk_free // (1024 * 1024),
+        'queue_depth': QUEUE_DEPTH.value(),
+        'active_jobs': ACTIVE_JOBS.value(),
+    }
+
+async def health(request):
+    """503 while the event loop is stalled or the disk is almost full"""
+    status = readiness()
+    return web.json_response(status, status=200 if status['status'] == 'ok' else 503)
+
+async def metrics(request):
+    return web.Response(text=render_metrics(), content_type='text/plain')
+
+async def home(request):
+    return web.json_response({'message': 'Thumbnail Changer Bot is Active'})
+
+def webhook_handler(application):
+    async def handle_update(request):
+        if request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        
+        # answered right away, the update is processed by the application
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+    return handle_update
+
+def build_web_app(application):
+    """Health and metrics endpoints plus the Telegram webhook, served from the bot's event loop"""
+    app = web.Application()
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_get('/', home)
+    app.router.add_post(WEBHOOK_PATH, webhook_handler(application))
+    return app
+
+async def start_web_server(application, port=PORT):
+    runner = web.AppRunner(build_web_app(application), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    logger.info(f"🌐 Web server listening on port {port}")
+    return runner
+
+async def set_webhook(application):
+    """Point Telegram at WEBHOOK_URL, returns False when polling should be used instead"""
+    if not WEBHOOK_URL:
+        return False
+    
+    url = WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH
+    try:
+        await application.bot.set_webhook(
+            url=url,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=max(1, min(MAX_CONCURRENT_UPDATES, 100))
+        )
+    except TelegramError as e:
+        logger.error(f"Could not set webhook {url}, falling back to polling: {e}")
+        return False
+    
+    logger.info(f"🌐 Receiving updates via webhook at {url}")
+    return True